@@ -1,6 +1,10 @@
+import hashlib, os, shutil
+import numpy as np
 
 import numba
-from numba import njit, cuda, jit
+from numba import njit, jit
+from numba.core.caching import (FunctionCache, CompileResultCacheImpl,
+                                 _CacheLocator, _SourceFileBackedLocatorMixin)
 
 import type_, kernel
 
@@ -8,23 +12,23 @@ from constant import *
 
 #event = None
 
-@cuda.jit(device=True)
-def syncthreads():
-    numba.cuda.syncthreads()
-
-
 # =============================================================================
 # Loop adapters
 # =============================================================================
 
-def loop(func, target):
-    if target == 'cpu':
-        return jit(func)
+def loop(func, alg, target):
+    if alg == 'history':
+        func = compiler(func, target)
+        def wrap(mcdc, data, hostco):
+            # Pass the one-element array holding the global record
+            func(mcdc.base, data, hostco)
+        return wrap
     else:
-        def wrap(mcdc, hostco):
+        # Host-side driver launching the event kernels
+        def wrap(mcdc, data, hostco):
             # Create device copies
             #d_mcdc = cuda.to_device(mcdc)
-            func(mcdc, hostco)
+            return func(mcdc, data, hostco)
             #d_mcdc.copy_to_host(mcdc)
         return wrap
 
@@ -36,7 +40,10 @@ def loop(func, target):
 # =============================================================================
 
 def event(func, alg, target, event, branching=False, naive=False):
-    func = compiler(func, "gpu_device")
+    if target in ['cpu', 'cpus']:
+        func = compiler(func, 'cpu')
+    else:
+        func = compiler(func, 'gpu_device')
 
     if alg != 'event':
         return func
@@ -45,7 +52,7 @@ def event(func, alg, target, event, branching=False, naive=False):
 
     wrap = None
 
-    def wrap_streaming(mcdc, hostco):
+    def wrap_streaming(mcdc, data, hostco):
 
         nonlocal func
 
@@ -53,32 +60,38 @@ def event(func, alg, target, event, branching=False, naive=False):
         stack = mcdc['stack_idx'][event]
         
         # Stack size
-        N = mcdc['stack_'][stack]['size']
+        N = mcdc['stack_size'][stack]
         start, stride = kernel.get_idx()
+
+        # RNG seed of the first particle, and jump to the next one
+        g, c = kernel.rng_jump(start*mcdc['event_stride'][event], mcdc)
+        seed = kernel.rng_advance(mcdc['seed'], g, c, mcdc)
+        g, c = kernel.rng_jump(stride*mcdc['event_stride'][event], mcdc)
+
         for i in range(start, N, stride):
             # Get particle index from stack
-            idx = mcdc['stack_'][stack]['content'][i]
+            idx = data.stack[stack, i]
             
             # "Pop" particle from bank
-            P = kernel.read_particle(mcdc['bank']['content'][idx])
+            P = kernel.bank_read(data.bank, idx)
 
             # Set RNG seed
-            P['seed'] = mcdc['seed']
-            kernel.rng_skip_ahead(i*mcdc['event_stride'][event], P, mcdc)
+            P['seed'] = seed
+            seed      = kernel.rng_advance(seed, g, c, mcdc)
 
             # Perform event
-            func(P, mcdc)
+            func(P, mcdc, data)
            
             # Update particle in the bank
-            mcdc['bank']['content'][idx] = kernel.record_particle(P)
+            kernel.bank_write(data.bank, idx, P['x'], P['ux'], P['w'])
                
             # Get stack index of the next event
             next_event = P['event']
             next_stack = mcdc['stack_idx'][next_event]
 
             # Update stack of the next event
-            idx_offset = mcdc['stack_'][next_stack]['size']
-            mcdc['stack_'][next_stack]['content'][idx_offset+i] = idx
+            idx_offset = mcdc['stack_size'][next_stack]
+            data.stack[next_stack, idx_offset+i] = idx
 
             # If last particle 
             if i == N-1:
@@ -86,142 +99,228 @@ def event(func, alg, target, event, branching=False, naive=False):
                 mcdc['seed'] = P['seed']
 
                 # Reset current event stack size
-                mcdc['stack_'][stack]['size'] = 0
-                hostco['stack_size'][stack]   = 0
+                mcdc['stack_size'][stack]   = 0
+                hostco['stack_size'][stack] = 0
 
                 # Update next event stack size
-                mcdc['stack_'][next_stack]['size'] += N
-                hostco['stack_size'][next_stack]   += N
+                mcdc['stack_size'][next_stack]   += N
+                hostco['stack_size'][next_stack] += N
 
-    def wrap_branching(mcdc, hostco):
+    # Branching events run in phases around an exclusive scan of the per-bin
+    # histogram of the next stacks, which needs a grid-wide sync on GPU
+
+    def branching_event(mcdc, data, hostco):
         # Stack index of the current event
         stack = mcdc['stack_idx'][event]
         # print(stack)
 
         # Stack size
-        N = mcdc['stack_'][stack]['size']
+        N = mcdc['stack_size'][stack]
         start, stride = kernel.get_idx()
+
+        # RNG seed of the first particle, and jump to the next one
+        g, c = kernel.rng_jump(start*mcdc['event_stride'][event], mcdc)
+        seed = kernel.rng_advance(mcdc['seed'], g, c, mcdc)
+        g, c = kernel.rng_jump(stride*mcdc['event_stride'][event], mcdc)
+
         for i in range(start, N, stride):
             #syncthreads()
             # Get particle index from stack
-            idx = mcdc['stack_'][stack]['content'][i]
+            idx = data.stack[stack, i]
 
             # "Pop" particle from bank
-            P = kernel.read_particle(mcdc['bank']['content'][idx])
+            P = kernel.bank_read(data.bank, idx)
 
             # Set RNG seed
-            P['seed'] = mcdc['seed']
-            kernel.rng_skip_ahead(i*mcdc['event_stride'][event], P, mcdc)
+            P['seed'] = seed
+            seed      = kernel.rng_advance(seed, g, c, mcdc)
 
             # Perform event
-            func(P, mcdc)
+            func(P, mcdc, data)
            
             # Update particle in the bank
-            mcdc['bank']['content'][idx] = kernel.record_particle(P)
+            kernel.bank_write(data.bank, idx, P['x'], P['ux'], P['w'])
 
             # Get stack index of the next event
             next_event = P['event']
             next_stack = mcdc['stack_idx'][next_event]
 
             # Update secondaries parameter (for sync. later)
-            mcdc['secondaries_stack'][i]                = next_stack
-            mcdc['secondaries_counter'][i, next_stack] += 1
+            data.secondaries_stack[i] = next_stack
             
-            # If last particle 
+            # If last particle, update main seed
             if i == N-1:
-                # Update main seed
                 mcdc['seed'] = P['seed']
 
-                # Reset current event stack size
-                mcdc['stack_'][stack]['size'] = 0
-                hostco['stack_size'][stack]   = 0
+    def branching_count(mcdc, data, hostco):
+        # Stack index of the current event
+        stack = mcdc['stack_idx'][event]
+
+        # Histogram of the next stacks in each bin of particles
+        N     = mcdc['stack_size'][stack]
+        N_bin = (N + SECONDARIES_BLOCK - 1) // SECONDARIES_BLOCK
+        start, stride = kernel.get_idx()
+        for b in range(start, N_bin, stride):
+            for j in range(mcdc['N_stack']):
+                data.secondaries_counter[b, j] = 0
+            for i in range(b*SECONDARIES_BLOCK,
+                           min((b+1)*SECONDARIES_BLOCK, N)):
+                data.secondaries_counter[b, data.secondaries_stack[i]] += 1
+
+    def branching_scatter(mcdc, data, hostco):
+        # Stack index of the current event
+        stack = mcdc['stack_idx'][event]
+
+        # Update all events stack based on the secondaries parameters
+        N = mcdc['stack_size'][stack]
+        start, stride = kernel.get_idx()
+        for i in range(start, N, stride):
+            # Get the stack and bin
+            next_stack = data.secondaries_stack[i]
+            b          = i // SECONDARIES_BLOCK
+
+            # Rank among the preceding particles of the bin going to the same
+            # stack, which keeps the stack order of a stable counting sort
+            rank = 0
+            for k in range(b*SECONDARIES_BLOCK, i):
+                if data.secondaries_stack[k] == next_stack:
+                    rank += 1
+
+            idx = data.secondaries_idx[b, next_stack] + rank + \
+                  mcdc['stack_size'][next_stack]
+                        
+            data.stack[next_stack, idx] = data.stack[stack, i]
+
+    def branching_scatter_serial(mcdc, data, hostco):
+        # Same stack order as branching_scatter, with one running cursor per
+        # next stack in place of the per-bin offsets and ranks
+        stack = mcdc['stack_idx'][event]
+        N     = mcdc['stack_size'][stack]
+
+        cursor = np.zeros(mcdc['N_stack'], dtype=np.int64)
+        for j in range(mcdc['N_stack']):
+            cursor[j] = mcdc['stack_size'][j]
+
+        for i in range(N):
+            next_stack = data.secondaries_stack[i]
+            data.stack[next_stack, cursor[next_stack]] = data.stack[stack, i]
+            cursor[next_stack] += 1
+
+    def branching_close(mcdc, data, hostco):
+        # Stack index of the current event
+        stack = mcdc['stack_idx'][event]
+        N     = mcdc['stack_size'][stack]
+        N_bin = (N + SECONDARIES_BLOCK - 1) // SECONDARIES_BLOCK
+
+        # Reset current event stack size
+        mcdc['stack_size'][stack] = 0
+
+        for j in range(mcdc['N_stack']):
+            # Get secondaries size
+            secondary_size = data.secondaries_idx[N_bin-1,j] + \
+                            data.secondaries_counter[N_bin-1,j]
+
+            # Update stack sizes
+            mcdc['stack_size'][j]  += secondary_size
+            hostco['stack_size'][j] = mcdc['stack_size'][j]
+
+    def wrap_branching(mcdc, data, hostco):
+        stack = mcdc['stack_idx'][event]
+        N     = mcdc['stack_size'][stack]
+        N_bin = (N + SECONDARIES_BLOCK - 1) // SECONDARIES_BLOCK
+
+        branching_event(mcdc, data, hostco)
+        branching_count(mcdc, data, hostco)
 
         # Launch exclusive scan algorithm [M. Harris 2007]
-        #  to get secondaries global indices
-        if (cuda.threadIdx.x == 0):
-            kernel.exscan(mcdc['secondaries_counter'], mcdc['secondaries_idx'], N)
-            stride = 1
-            # Update all events stack based on the secondaries parameters
-            for i in range(start, N, stride):
-                # Get the stack and index
-                next_stack = mcdc['secondaries_stack'][i]
-                idx        = mcdc['secondaries_idx'][i, next_stack] + \
-                            mcdc['stack_'][next_stack]['size']
-                            
-                mcdc['stack_'][next_stack]['content'][idx] = \
-                        mcdc['stack_'][stack]['content'][i]
-
-                # If last particle, update stack sizes
-                if i == N-1:
-                    for j in range(mcdc['N_stack']):
-                        # Get secondaries size
-                        secondary_size = mcdc['secondaries_idx'][N-1,j] + \
-                                        mcdc['secondaries_counter'][N-1,j]
-
-                        # Update stack sizes
-                        mcdc['stack_'][j]['size'] += secondary_size
-                        hostco['stack_size'][j]   += secondary_size
-                
-                # Reset secondaries parameters
-                for j in range(mcdc['N_stack']):
-                    mcdc['secondaries_counter'][i, j] = 0
-                    mcdc['secondaries_idx'][i, j]     = 0
-        #syncthreads()
+        #  to get secondaries global bin offsets
+        kernel.exscan(data.secondaries_counter, data.secondaries_idx, N_bin)
+
+        branching_scatter(mcdc, data, hostco)
+        branching_close(mcdc, data, hostco)
     
-    def wrap_naive(mcdc, hostco, event):
+    def wrap_naive(mcdc, data, hostco):
         # Stack index of the current event
         stack = mcdc['stack_idx'][event]
 
         # Stack size
-        N = mcdc['stack_'][stack]['size']
+        N = mcdc['stack_size'][stack]
         start, stride = kernel.get_idx()
+
+        # RNG seed of the first particle, and jump to the next one
+        g, c = kernel.rng_jump(start*mcdc['event_stride'][event], mcdc)
+        seed = kernel.rng_advance(mcdc['seed'], g, c, mcdc)
+        g, c = kernel.rng_jump(stride*mcdc['event_stride'][event], mcdc)
+
         for i in range(start, N, stride):
             # Get particle index from stack
-            idx = mcdc['stack_'][stack]['content'][i]
+            idx = data.stack[stack, i]
 
             # "Pop" particle from bank
-            P = kernel.read_particle(mcdc['bank']['content'][idx])
+            P = kernel.bank_read(data.bank, idx)
 
             # Set RNG seed
-            P['seed'] = mcdc['seed']
-            kernel.rng_skip_ahead(i*mcdc['event_stride'][event], P, mcdc)
+            P['seed'] = seed
+            seed      = kernel.rng_advance(seed, g, c, mcdc)
 
-            func(P, mcdc)
+            func(P, mcdc, data)
            
             # Update particle in the bank
-            mcdc['bank']['content'][idx] = kernel.record_particle(P)
+            kernel.bank_write(data.bank, idx, P['x'], P['ux'], P['w'])
                
             # Get stack index of the next event
             next_event = P['event']
             next_stack = mcdc['stack_idx'][next_event]
 
             # Update stack of the next event
-            idx_next_stack = mcdc['stack_'][next_stack]['size']
-            mcdc['stack_'][next_stack]['content'][idx_next_stack] = idx
-            mcdc['stack_'][next_stack]['size'] += 1
+            idx_next_stack = mcdc['stack_size'][next_stack]
+            data.stack[next_stack, idx_next_stack] = idx
+            mcdc['stack_size'][next_stack] += 1
 
             # If last particle 
             if i == N-1:
                 # Update main seed
                 mcdc['seed'] = P['seed']
 
-                # Reset current event stack size
-                mcdc['stack_'][stack]['size'] = 0
+                # Reset current event stack size, keeping the particles
+                # pushed to it while it ran (split copies of a fused pair)
+                N_pushed = mcdc['stack_size'][stack] - N
+                for j in range(N_pushed):
+                    data.stack[stack, j] = data.stack[stack, N+j]
+                mcdc['stack_size'][stack] = N_pushed
                 
                 # Update hostc controller
                 for j in range(mcdc['N_stack']):
-                    hostco['stack_size'][j] = mcdc['stack_'][j]['size']
+                    hostco['stack_size'][j] = mcdc['stack_size'][j]
+
+    if target in ['cpu', 'cpus']:
+        # Event wrappers run serially; only the scan is threaded on cpus
+        if naive:
+            wrap = compiler(wrap_naive, 'cpu')
+        elif branching:
+            branching_event   = compiler(branching_event, 'cpu')
+            branching_count   = compiler(branching_count, 'cpu')
+            branching_scatter = compiler(branching_scatter_serial, 'cpu')
+            branching_close   = compiler(branching_close, 'cpu')
+            wrap = compiler(wrap_branching, 'cpu')
+        else:
+            wrap = compiler(wrap_streaming, 'cpu')
+
+        # Same call signature as the GPU wrapper; there are no device copies
+        def host_wrap(mcdc, d_mcdc, data, d_data, hostco, d_hostco):
+            wrap(mcdc, data, hostco)
+        return host_wrap
 
     if naive:
         wrap = compiler(wrap_naive, target)
     elif branching:
-        wrap = compiler(wrap_branching, target)
+        branching_event   = compiler(branching_event, target)
+        branching_count   = compiler(branching_count, target)
+        branching_scatter = compiler(branching_scatter, target)
+        branching_close   = compiler(branching_close, target)
     else:
         wrap = compiler(wrap_streaming, target)
 
-    if target == 'cpu':
-        return wrap
-
     # GPU-Event-based zone below
     def gpu_config(N, hostco):
         N_thread = hostco['N_thread']
@@ -230,17 +329,21 @@ def event(func, alg, target, event, branching=False, naive=False):
         return N_block, N_thread
 
     #print(event)
-    def hardware_wrap(mcdc, gpu_mcdc, hostco, gpu_hostco):
-        nonlocal event
-        nonlocal wrap
-        # recorrecting event index in stack if branchless collision
-        if mcdc['branchless_collision']:
-            if event == 6:
-                event = 4
-            elif event == 5:
-                event = 3
-        N_block, N_thread = gpu_config(hostco['stack_size'][event], hostco)
-        wrap[N_block, N_thread](gpu_mcdc, hostco)
+    def hardware_wrap(mcdc, gpu_mcdc, data, gpu_data, hostco, gpu_hostco):
+        stack = mcdc['stack_idx'][event]
+        N     = hostco['stack_size'][stack]
+        N_block, N_thread = gpu_config(N, hostco)
+        if branching:
+            N_bin = (N + SECONDARIES_BLOCK - 1) // SECONDARIES_BLOCK
+            branching_event[N_block, N_thread](gpu_mcdc, gpu_data, hostco)
+            N_block_bin, _ = gpu_config(N_bin, hostco)
+            branching_count[N_block_bin, N_thread](gpu_mcdc, gpu_data, hostco)
+            kernel.exscan(gpu_data.secondaries_counter,
+                          gpu_data.secondaries_idx, N_bin)
+            branching_scatter[N_block, N_thread](gpu_mcdc, gpu_data, hostco)
+            branching_close[1, 1](gpu_mcdc, gpu_data, hostco)
+        else:
+            wrap[N_block, N_thread](gpu_mcdc, gpu_data, hostco)
 
     return hardware_wrap
 
@@ -252,15 +355,137 @@ def event(func, alg, target, event, branching=False, naive=False):
 
 def compiler(func, target):
     if target == 'cpu':
-        return jit(func, nopython=True, nogil=True)#, parallel=True)
+        compiled = jit(func, nopython=True, nogil=True)#, parallel=True)
     elif target == 'cpus':
-        return jit(func, nopython=True, nogil=True, parallel=True)
+        compiled = jit(func, nopython=True, nogil=True, parallel=True)
     elif target == 'gpu_device':
+        # Cached as part of the kernels calling it
+        from numba import cuda
         return cuda.jit(func,device=True)
     elif target == 'gpu':
-        return cuda.jit(func)
+        from numba import cuda
+        compiled = cuda.jit(func)
     else:
         print(f"[ERROR] Unrecognized target '{target}'.")
+        return
+
+    # Python mode returns the function itself
+    if cache and hasattr(compiled, 'enable_caching'):
+        if target == 'gpu':
+            compiled._cache = CUDAKernelCache(compiled.py_func)
+        else:
+            compiled._cache = KernelCache(compiled.py_func)
+    return compiled
+
+# =============================================================================
+# On-disk kernel cache
+# =============================================================================
+
+# The cache classes below hook into Numba internals (cache locators and
+# index keys) as of this version; other versions run without the cache
+CACHE_NUMBA_VERSION = '0.68'
+
+cache     = False
+cache_dir = None
+
+def set_cache(alg, target, branchless_collision, rng_type, soa_bank,
+              path=None, mpi=False):
+    # Cache compiled kernels and loops in a directory per configuration: the
+    # factories bake the configuration and the global layout into the kernels
+    # and inline code across modules, so Numba's per-file stamps are not
+    # enough. The directory is emptied when any of those modules changes.
+    global cache, cache_dir
+
+    if numba.__version__.split('.')[:2] != CACHE_NUMBA_VERSION.split('.'):
+        print(f"[INFO] Kernel cache disabled: written for Numba "
+              f"{CACHE_NUMBA_VERSION}, running {numba.__version__}.")
+        cache = False
+        return
+
+    here   = os.path.dirname(os.path.abspath(__file__))
+    config = repr((alg, target, branchless_collision, rng_type, soa_bank,
+                   type_.global_.descr))
+    if path is None:
+        path = os.path.join(here, '__kernel_cache__')
+    path = os.path.join(path, hashlib.sha256(config.encode()).hexdigest()[:16])
+
+    sources = hashlib.sha256()
+    for name in ['adapter', 'constant', 'kernel', 'loop', 'type_']:
+        with open(os.path.join(here, name + '.py'), 'rb') as f:
+            sources.update(f.read())
+    stamp      = sources.hexdigest()
+    stamp_file = os.path.join(path, 'sources.sha256')
+
+    # Under MPI, only rank 0 clears and stamps the directory, which all ranks
+    # share; the others wait for it
+    comm = None
+    if mpi:
+        from mpi4py import MPI
+        comm = MPI.COMM_WORLD
+    if comm is None or comm.Get_rank() == 0:
+        if os.path.isfile(stamp_file):
+            with open(stamp_file) as f:
+                if f.read() != stamp:
+                    shutil.rmtree(path)
+        if not os.path.isfile(stamp_file):
+            os.makedirs(path, exist_ok=True)
+            with open(stamp_file, 'w') as f:
+                f.write(stamp)
+    if comm is not None:
+        comm.Barrier()
+
+    cache_dir = path
+    cache     = True
+
+def closure_key(func):
+    # Stable description of the closure variables of func; compiled functions
+    # go by name (and their own closure) as they pickle with a per-process id
+    if func.__closure__ is None:
+        return ''
+    key = []
+    for cell in func.__closure__:
+        x = getattr(cell.cell_contents, 'py_func', cell.cell_contents)
+        if hasattr(x, '__code__'):
+            key.append(f'{x.__module__}.{x.__qualname__}({closure_key(x)})')
+        else:
+            key.append(repr(x))
+    return ','.join(key)
+
+class StableIndexKey:
+    # Numba keys cached closures on their pickled closure variables, which
+    # would miss on every run for the adapter closures
+    def _index_key(self, sig, codegen):
+        hasher = lambda x: hashlib.sha256(x).hexdigest()
+        return (sig, codegen.magic_tuple(),
+                (hasher(self._py_func.__code__.co_code),
+                 hasher(closure_key(self._py_func).encode())))
+
+class KernelCacheLocator(_SourceFileBackedLocatorMixin, _CacheLocator):
+    # Numba's locator for numba.config.CACHE_DIR, with the directory of
+    # set_cache instead, so that the global config is left alone
+    def __init__(self, py_func, py_file):
+        self._py_file    = py_file
+        self._lineno     = py_func.__code__.co_firstlineno
+        subpath          = self.get_suitable_cache_subpath(py_file)
+        self._cache_path = os.path.join(cache_dir, subpath)
+
+    def get_cache_path(self):
+        return self._cache_path
+
+class KernelCacheImpl(CompileResultCacheImpl):
+    _locator_classes = [KernelCacheLocator]
+
+class KernelCache(StableIndexKey, FunctionCache):
+    _impl_class = KernelCacheImpl
+
+def CUDAKernelCache(py_func):
+    # Imported here, as the CUDA simulator has no kernel cache
+    from numba.cuda.dispatcher import CUDACache, CUDACacheImpl
+    class Impl(CUDACacheImpl):
+        _locator_classes = [KernelCacheLocator]
+    class Cache(StableIndexKey, CUDACache):
+        _impl_class = Impl
+    return Cache(py_func)
 
 def parallel_compile(func):
     return jit(func, nopython=True, nogil=True, parallel=True)
@@ -0,0 +1,112 @@
+import argparse, itertools, json, os, subprocess, sys
+
+import numpy as np
+
+# =============================================================================
+# Benchmark sweep over main.py configurations
+# =============================================================================
+# Each configuration runs main.py twice on the same kernels, without the
+# on-disk cache: the first run includes the JIT compilation, the second is
+# warm. Results go out as a JSON list.
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--mode', type=str, nargs='+', default=['numba'],
+                    choices=['python', 'numba'])
+parser.add_argument('--alg', type=str, nargs='+', default=['history', 'event'],
+                    choices=['history', 'event'])
+parser.add_argument('--target', type=str, nargs='+', default=['cpu'],
+                    choices=['cpu', 'gpu', 'cpus'])
+parser.add_argument('--N_particle', type=float, nargs='+',
+                    default=[1E4, 1E5])
+parser.add_argument('--branchless_collision', type=int, nargs='+',
+                    default=[1, 0], choices=[0, 1])
+parser.add_argument('--state', type=str, nargs='+', default=['ram'],
+                    choices=['ram', 'file', 'hugepage'],
+                    help='Memory backing of the global state')
+parser.add_argument('--output', type=str, default=None,
+                    help='JSON file (default: stdout)')
+args = parser.parse_args()
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+# =============================================================================
+# Run
+# =============================================================================
+
+def run(mode, alg, target, N_particle, branchless_collision, state):
+    command = [sys.executable, os.path.join(here, 'main.py'),
+               '--mode', mode, '--alg', alg, '--target', target,
+               '--N_particle', str(N_particle),
+               '--branchless_collision', str(branchless_collision),
+               '--state', state,
+               '--no_cache', '--repeat', '2', '--json']
+    result = subprocess.run(command, capture_output=True, text=True, cwd=here)
+
+    record = {'mode': mode, 'alg': alg, 'target': target,
+              'N_particle': int(N_particle),
+              'branchless_collision': bool(branchless_collision),
+              'state': state}
+    lines = result.stdout.strip().splitlines()
+    if result.returncode != 0 or not lines or not lines[-1].startswith('{'):
+        # Unsupported combination ([ERROR] line) or failure (exception line)
+        error = [line for line in lines if line.startswith('[ERROR]')] + \
+                [line for line in result.stderr.splitlines()
+                 if 'Error' in line.split(':')[0]]
+        record['error'] = error[-1] if error else 'no output'
+        return record
+
+    summary    = json.loads(lines[-1])
+    cold, warm = summary['run_time']
+    record.update({
+        'compile_time'    : cold - warm,
+        'warm_time'       : warm,
+        'particles_per_s' : int(N_particle)/warm,
+        'peak_rss_kb'     : summary['peak_rss_kb'],
+        'tally'           : summary['tally']})
+    return record
+
+records = []
+for mode, alg, target, N_particle, branchless, state in itertools.product(
+        args.mode, args.alg, args.target, args.N_particle,
+        args.branchless_collision, args.state):
+    record = run(mode, alg, target, N_particle, branchless, state)
+    if 'error' in record:
+        status = record['error']
+    else:
+        status = f"{record['particles_per_s']:.3g} particles/s"
+    print(f"[INFO] {mode} {alg} {target} N={int(N_particle)} "
+          f"branchless={branchless} state={state}: {status}", file=sys.stderr)
+    records.append(record)
+
+# =============================================================================
+# Tally agreement
+# =============================================================================
+# Against the first successful run of the same problem (N_particle and
+# branchless mode). Tallies are leakage counts (or weights), so runs with
+# different random streams agree if within 3 sigma, sigma^2 ~ a + b.
+
+reference = {}
+for record in records:
+    if 'error' in record:
+        continue
+    key = (record['N_particle'], record['branchless_collision'])
+    if key not in reference:
+        reference[key] = record
+    ref   = np.array(reference[key]['tally'])
+    tally = np.array(record['tally'])
+    diff  = np.abs(tally - ref)
+    sigma = np.sqrt(np.abs(tally) + np.abs(ref))
+    record['tally_reference'] = ' '.join([reference[key][k] for k in
+                                          ['mode', 'alg', 'target', 'state']])
+    record['tally_max_rel_diff'] = float(np.max(diff/np.maximum(np.abs(ref), 1)))
+    record['tally_agree'] = bool(np.all(diff <= 3.0*sigma))
+
+# =============================================================================
+# Output
+# =============================================================================
+
+if args.output is None:
+    print(json.dumps(records, indent=2))
+else:
+    with open(args.output, 'w') as f:
+        json.dump(records, f, indent=2)
@@ -4,6 +4,15 @@ RNG_STRIDE = 152917
 RNG_G      = 2806196910506780709
 RNG_C      = 1
 RNG_MOD    = 2**63
+RNG_BITS   = 63 # log2(RNG_MOD), size of the skip-ahead table
+RNG_SOURCE = 2  # Draws of a source particle, taken as one batch
+
+# Counter-based RNG (Threefry-2x32)
+RNG_THREEFRY_ROT    = (13, 15, 26, 6, 17, 29, 16, 24)
+RNG_THREEFRY_PARITY = 0x1BD11BDA
+
+# GPU exclusive scan (rows per block, two per thread; power of two)
+EXSCAN_BLOCK = 64
 
 # EVENT
 EVENT_NONE                 = 0 # Particle is dead
@@ -14,3 +23,38 @@ EVENT_FISSION              = 4
 EVENT_LEAKAGE              = 5
 EVENT_BRANCHLESS_COLLISION = 6
 N_EVENT                    = 7
+
+# Histories per tally partial sum; fixed, so that the reduction order does
+# not depend on the number of threads
+TALLY_BLOCK = 1000
+
+# Minimum number of batches before a convergence check can stop a run
+CONVERGENCE_MIN_BATCH = 10
+
+# Mesh tally estimators
+MESH_TRACK       = 0
+MESH_COLLISION   = 1
+N_MESH_ESTIMATOR = 2
+
+# Counters (indexed by event, then the extra ones below)
+COUNTER_CAPTURE    = N_EVENT     # Captures, which happen in move
+COUNTER_BANK_DEPTH = N_EVENT + 1 # Maximum history bank size
+N_COUNTER          = N_EVENT + 2
+STACK_HISTORY_SIZE = 10000       # Iterations of event stack sizes kept
+
+# Event scheduling thresholds, as fractions of the source particles
+SCHEDULE_OCCUPANCY = 0.05 # Minimum stack size run by the threshold policy
+SCHEDULE_TAIL      = 0.01 # Population below which the tail is drained
+
+# Particles per histogram bin of the branching-event secondaries
+SECONDARIES_BLOCK = 64
+
+# Bank
+BANK_HISTORY_SIZE = 1000 # Initial per-thread bank of history-based runs
+
+# Checkpoint file signature
+CHECKPOINT_MAGIC = b'MCDC-BIT'
+
+# Population control
+WW_SPLIT_MAX      = 10  # Maximum number of particles a split makes
+COMB_HISTORY_SIZE = 100 # Particles kept when combing a history bank
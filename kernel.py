@@ -2,7 +2,9 @@ import math
 import numpy as np
 
 import numba
-from numba import cuda, njit
+from numba import njit, prange
+
+cuda = None # numba.cuda, imported by make_kernels for GPU runs
 
 from constant import *
 
@@ -12,19 +14,21 @@ import type_, adapter
 # Events
 # =============================================================================
 
-leakeag_try = np.array([0,0], dtype=np.float32)
-leakeag_tryd = cuda.to_device(leakeag_try)
-
+def source(P, mcdc, data):
+    count(mcdc, EVENT_SOURCE)
 
-def source(P, mcdc):
-    P['x']     = -mcdc['X'] + 2.0*mcdc['X']*rng(P, mcdc)
-    P['ux']    = -1.0 + 2.0*rng(P, mcdc)
+    xi = create_draws()
+    rng_batch(P, mcdc, xi)
+    P['x']     = -mcdc['X'] + 2.0*mcdc['X']*xi[0]
+    P['ux']    = -1.0 + 2.0*xi[1]
     P['w']     = 1.0
     P['alive'] = True
 
     P['event'] = EVENT_MOVE
 
-def move(P, mcdc):
+def move(P, mcdc, data):
+    count(mcdc, EVENT_MOVE)
+
     SigmaT = mcdc['SigmaT']
     SigmaC = mcdc['SigmaC']
     SigmaS = mcdc['SigmaS']
@@ -32,8 +36,12 @@ def move(P, mcdc):
 
     # Sample collision distance
     distance  = -math.log(rng(P, mcdc))/SigmaT
+    x_old     = P['x']
     P['x']   += P['ux']*distance
 
+    # Score track-length flux
+    mesh_track(P, x_old, distance, mcdc)
+
     # Now, determine event
 
     # Leakage?
@@ -42,12 +50,17 @@ def move(P, mcdc):
 
     # Collision
     else:
+        # Score collision flux
+        mesh = mcdc['mesh_buffer'][get_buffer_idx(), MESH_COLLISION]
+        atomic_add(mesh, P['w']/SigmaT, mesh_bin(P['x'], mcdc))
+
         if mcdc['branchless_collision']:
             P['event'] = EVENT_BRANCHLESS_COLLISION
         else:
             xi = rng(P, mcdc)*SigmaT
             tot = SigmaC
             if tot > xi:
+                count(mcdc, COUNTER_CAPTURE)
                 terminate_particle(P)
                 return
             else:
@@ -58,8 +71,10 @@ def move(P, mcdc):
                     P['event'] = EVENT_FISSION
 
 
-def branchless_collision(P, mcdc):
+def branchless_collision(P, mcdc, data):
     #print('in bc')
+    count(mcdc, EVENT_BRANCHLESS_COLLISION)
+
     SigmaT = mcdc['SigmaT']
     SigmaS = mcdc['SigmaS']
     SigmaF = mcdc['SigmaF']
@@ -70,13 +85,19 @@ def branchless_collision(P, mcdc):
 
     P['event'] = EVENT_MOVE
 
-def scattering(P, mcdc):
+    weight_window(P, mcdc, data)
+
+def scattering(P, mcdc, data):
+    count(mcdc, EVENT_SCATTERING)
+
     P['ux'] = -1.0 + 2.0*rng(P, mcdc)
     
     P['event'] = EVENT_MOVE
 
+    weight_window(P, mcdc, data)
+
 
-def async_fission(P, mcdc):
+def async_fission(P, mcdc, data):
     #print('in fission')
     nu = mcdc['nu']
 
@@ -85,8 +106,10 @@ def async_fission(P, mcdc):
     return n
 
 
-def fission(P, mcdc):
+def fission(P, mcdc, data):
     #print('in fission')
+    count(mcdc, EVENT_FISSION)
+
     nu = mcdc['nu']
 
     # Sample number of fission neutrons
@@ -98,47 +121,124 @@ def fission(P, mcdc):
         P_new['x']  = P['x']
         P_new['ux'] = -1.0 + 2.0*rng(P, mcdc)
         P_new['w']  = P['w']
-
-        # Push to bank and update stack (for event-based)
-        if mcdc['history_based']:
-            idx = mcdc['bank']['size']
-            mcdc['bank']['content'][idx] = P_new
-            mcdc['bank']['size'] += 1
-        else: # Event based
-            # Get the index of the next idle particle in the bank
-            mcdc['stack_'][EVENT_NONE]['size'] -= 1
-            idx      = mcdc['stack_'][EVENT_NONE]['size']
-            idx_bank = mcdc['stack_'][EVENT_NONE]['content'][idx]
-
-            # Push the new particle
-            mcdc['bank']['content'][idx_bank] = P_new
-
-            # Mark the new particle in the bank in the next event stack
-            idx = mcdc['stack_'][EVENT_MOVE]['size']
-            mcdc['stack_'][EVENT_MOVE]['content'][idx]  = idx_bank
-            mcdc['stack_'][EVENT_MOVE]['size']         += 1
-
+        bank_push(P_new, mcdc, data)
 
     terminate_particle(P)
 
-def leakage(P, mcdc): 
+def leakage(P, mcdc, data):
     #print('in leak')
+    count(mcdc, EVENT_LEAKAGE)
+
+    # Leaked weight (particle count in analog runs)
+    tally = mcdc['tally_buffer'][get_buffer_idx()]
     if P['ux'] > 0.0:
-        atomic_add(mcdc['tally'], 1, 1)
-        atomic_add(mcdc['tally'], 1, 2)
+        atomic_add(tally, P['w'], 1)
+        atomic_add(tally, P['w'], 2)
     else:
-        atomic_add(mcdc['tally'], 1, 0)
-        atomic_add(mcdc['tally'], 1, 2)
+        atomic_add(tally, P['w'], 0)
+        atomic_add(tally, P['w'], 2)
     
     terminate_particle(P)
 
+# =============================================================================
+# Fused events
+# =============================================================================
+
+def fused_event(first, second, leak, first_event, second_event, next_event):
+    # Particle-level kernel running first, then second (or leakage) if first
+    # leads to it, in one pass. A fused pair runs on the stacks of both its
+    # events: particles going on to first_event are sent to next_event, so
+    # that they alternate between the two stacks.
+    def fused(P, mcdc, data):
+        first(P, mcdc, data)
+        if P['event'] == second_event:
+            second(P, mcdc, data)
+        elif P['event'] == EVENT_LEAKAGE:
+            leak(P, mcdc, data)
+        if P['event'] == first_event:
+            P['event'] = next_event
+    return fused
+
+# =============================================================================
+# Population control
+# =============================================================================
+
+def weight_window(P, mcdc, data):
+    # Russian roulette below the window (survivors get the survival weight)
+    # and splitting above it, into at most WW_SPLIT_MAX particles; both keep
+    # the expected weight
+    if not mcdc['weight_window']:
+        return
+
+    w = P['w']
+    if w < mcdc['ww_low']:
+        if rng(P, mcdc)*mcdc['ww_survival'] < w:
+            P['w'] = mcdc['ww_survival']
+        else:
+            terminate_particle(P)
+    elif w > mcdc['ww_high']:
+        n      = min(int(math.ceil(w/mcdc['ww_high'])), WW_SPLIT_MAX)
+        P['w'] = w/n
+        for i in range(n-1):
+            P_new       = np.zeros(1, dtype=type_.particle_rec)[0]
+            P_new['x']  = P['x']
+            P_new['ux'] = P['ux']
+            P_new['w']  = P['w']
+            bank_push(P_new, mcdc, data)
+
+def NO_weight_window(P, mcdc, data):
+    pass
+
+def comb_bank(P, mcdc, data):
+    # Comb the caller's history bank, if it holds more than
+    # COMB_HISTORY_SIZE particles, down to that many: evenly spaced teeth,
+    # with a random offset, over the cumulative weight; each particle is
+    # copied once per tooth falling in its weight, with the tooth spacing as
+    # weight. The total weight is kept, as well as the expected weight of
+    # each particle.
+    i_buffer = get_buffer_idx()
+    N        = mcdc['bank_history_size'][i_buffer]
+    if not mcdc['comb'] or N <= COMB_HISTORY_SIZE:
+        return
+
+    bank    = data.bank_history[i_buffer]
+    M       = COMB_HISTORY_SIZE
+    content = bank[:N].copy()
+    W       = 0.0
+    for i in range(N):
+        W += content[i]['w']
+    spacing = W/M
+
+    tooth = rng(P, mcdc)*spacing
+    j     = 0
+    edge  = content[0]['w']
+    for k in range(M):
+        while tooth >= edge and j < N-1:
+            j    += 1
+            edge += content[j]['w']
+        P_rec       = bank[k]
+        P_rec['x']  = content[j]['x']
+        P_rec['ux'] = content[j]['ux']
+        P_rec['w']  = spacing
+        tooth += spacing
+    mcdc['bank_history_size'][i_buffer] = M
+
+    # Check: the combed bank holds M particles with the same total weight
+    W_comb = 0.0
+    for k in range(mcdc['bank_history_size'][i_buffer]):
+        W_comb += bank[k]['w']
+    if mcdc['bank_history_size'][i_buffer] != M \
+       or abs(W_comb - W) > 1E-10*W:
+        print('[ERROR] Combed history bank lost particles or weight.')
+
 
 
 # =============================================================================
 # RNG
 # =============================================================================
 
-def rng(P, mcdc):
+rng = None
+def LCG_rng(P, mcdc):
     seed     = int(P['seed'])
     g        = int(mcdc['rng_g'])
     c        = int(mcdc['rng_c'])
@@ -150,28 +250,119 @@ def rng(P, mcdc):
     P['seed'] = (g*seed + c) & mod_mask
     return P['seed']/mod
 
-def rng_skip_ahead(n, P, mcdc):
-    n        = int(n)
+rng_batch = None
+def LCG_rng_batch(P, mcdc, xi):
+    # Fill xi with consecutive random numbers of the particle
+    for i in range(xi.shape[0]):
+        xi[i] = rng(P, mcdc)
+
+rng_skip_ahead = None
+def LCG_rng_skip_ahead(n, P, mcdc):
     seed     = int(P['seed'])
-    g        = int(mcdc['rng_g'])
-    c        = int(mcdc['rng_c'])
-    mod      = int(mcdc['rng_mod'])
-    mod_mask = int(mod - 1)
+    g, c     = rng_jump(n, mcdc)
+    mod_mask = int(int(mcdc['rng_mod']) - 1)
+
+    P['seed'] = (g*seed + c) & mod_mask
+    #sync()
+
+rng_jump = None
+def LCG_rng_jump(n, mcdc):
+    # Coefficients (g, c) of the n-step jump, seed -> g*seed + c, composed
+    # from the precomputed power-of-two jumps
+    n        = int(n)
+    mod_mask = int(int(mcdc['rng_mod']) - 1)
     g_new    = 1
     c_new    = 0
     
     n = n & mod_mask
+    k = 0
     while n > 0:
         if n & 1:
+            g     = int(mcdc['rng_jump_g'][k])
+            c     = int(mcdc['rng_jump_c'][k])
             g_new = g_new*g       & mod_mask
             c_new = (c_new*g + c) & mod_mask
+        n >>= 1
+        k  += 1
+
+    return g_new, c_new
+
+def rng_advance(seed, g, c, mcdc):
+    # Apply jump coefficients from rng_jump to a seed
+    mod_mask = int(int(mcdc['rng_mod']) - 1)
+    return (g*int(seed) + c) & mod_mask
+
+def rng_jump_table(mcdc):
+    # Host-side, once per run: jump coefficients for 2^k steps
+    g        = int(mcdc['rng_g'])
+    c        = int(mcdc['rng_c'])
+    mod_mask = int(mcdc['rng_mod']) - 1
+    for k in range(RNG_BITS):
+        mcdc['rng_jump_g'][k] = g
+        mcdc['rng_jump_c'][k] = c
 
         c = (g+1)*c & mod_mask
         g = g*g     & mod_mask
-        n >>= 1
 
-    P['seed'] = (g_new*seed + c_new) & mod_mask
-    #sync()
+# ==================================
+# RNG: counter-based (Threefry-2x32-20)
+# ==================================
+
+# The particle seed is the stream position (history or stack index times
+# stride, plus the draws so far) and is used as the counter, keyed on
+# mcdc['rng_key']. Draws need no state shared between threads and any
+# skip-ahead is a plain addition.
+
+def threefry(counter, mcdc):
+    # [J. K. Salmon et al. 2011]
+    M32 = 0xFFFFFFFF
+    key = int(mcdc['rng_key'])
+    k0  = key & M32
+    k1  = (key >> 32) & M32
+    k2  = RNG_THREEFRY_PARITY ^ k0 ^ k1
+    x0  = ((counter & M32) + k0) & M32
+    x1  = (((counter >> 32) & M32) + k1) & M32
+
+    for r in range(20):
+        rot = RNG_THREEFRY_ROT[r % 8]
+        x0  = (x0 + x1) & M32
+        x1  = ((x1 << rot) | (x1 >> (32 - rot))) & M32
+        x1 ^= x0
+
+        # Key injection every four rounds
+        if r % 4 == 3:
+            s = r // 4 + 1
+            if s % 3 == 0:
+                x0 = (x0 + k0) & M32
+                x1 = (x1 + k1 + s) & M32
+            elif s % 3 == 1:
+                x0 = (x0 + k1) & M32
+                x1 = (x1 + k2 + s) & M32
+            else:
+                x0 = (x0 + k2) & M32
+                x1 = (x1 + k0 + s) & M32
+
+    # 53-bit float in (0, 1)
+    return (((x0 << 21) | (x1 >> 11)) + 0.5)/2**53
+
+def THREEFRY_rng(P, mcdc):
+    counter   = int(P['seed'])
+    P['seed'] = counter + 1
+    return threefry(counter, mcdc)
+
+def THREEFRY_rng_batch(P, mcdc, xi):
+    # The draws are independent of each other, one counter each
+    counter = int(P['seed'])
+    for i in range(xi.shape[0]):
+        xi[i] = threefry(counter + i, mcdc)
+    P['seed'] = counter + xi.shape[0]
+
+def THREEFRY_rng_skip_ahead(n, P, mcdc):
+    P['seed'] = int(P['seed']) + int(n)
+
+def THREEFRY_rng_jump(n, mcdc):
+    # Same (g, c) form as the LCG jump
+    return 1, int(n)
 
 # =============================================================================
 # Utilities
@@ -194,12 +385,156 @@ def read_particle(P_rec):
     #sync()
     return P
 
+# Event-based bank access, for either bank layout
+bank_read = None
+def AOS_bank_read(bank, idx):
+    return read_particle(bank[idx])
+
+def SOA_bank_read(bank, idx):
+    # Rows of the bank in particle_rec field order
+    P = create(type_.particle)
+    P['x']     = bank[0, idx]
+    P['ux']    = bank[1, idx]
+    P['w']     = bank[2, idx]
+    P['alive'] = True
+    return P
+
+bank_write = None
+def bank_push(P_new, mcdc, data):
+    # Push a secondary particle record to the bank; in event-based runs, it
+    # takes an idle bank slot and joins the move stack. On overflow, flag it
+    # for the host to grow the bank and drop the particle (history-based, the
+    # thread's flag also ends its history, to be run again).
+    if mcdc['history_based']:
+        i   = get_buffer_idx()
+        idx = mcdc['bank_history_size'][i]
+        if idx == data.bank_history.shape[1]:
+            mcdc['bank_overflow']            = True
+            mcdc['bank_history_overflow'][i] = 1
+            return
+        data.bank_history[i, idx]     = P_new
+        mcdc['bank_history_size'][i] += 1
+    else: # Event based
+        if mcdc['stack_size'][EVENT_NONE] == 0:
+            mcdc['bank_overflow'] = True
+            return
+
+        # Get the index of the next idle particle in the bank
+        mcdc['stack_size'][EVENT_NONE] -= 1
+        idx      = mcdc['stack_size'][EVENT_NONE]
+        idx_bank = data.stack[EVENT_NONE, idx]
+
+        # Push the new particle
+        bank_write(data.bank, idx_bank, P_new['x'], P_new['ux'], P_new['w'])
+
+        # Mark the new particle in the bank in the next event stack
+        idx = mcdc['stack_size'][EVENT_MOVE]
+        data.stack[EVENT_MOVE, idx]     = idx_bank
+        mcdc['stack_size'][EVENT_MOVE] += 1
+
+# The fields are passed by value, so that particles and particle records
+# (and a record that shares memory with the slot) write the same way
+def AOS_bank_write(bank, idx, x, ux, w):
+    P_rec       = bank[idx]
+    P_rec['x']  = x
+    P_rec['ux'] = ux
+    P_rec['w']  = w
+
+def SOA_bank_write(bank, idx, x, ux, w):
+    bank[0, idx] = x
+    bank[1, idx] = ux
+    bank[2, idx] = w
+
+def mesh_bin(x, mcdc):
+    X = mcdc['X']
+    i = int((x + X)/(2.0*X)*mcdc['N_mesh'])
+    return min(max(i, 0), mcdc['N_mesh'] - 1)
+
+def mesh_track(P, x_old, distance, mcdc):
+    # Weighted track length of the flight from x_old in each mesh bin, with
+    # the part outside [-X, X] cut off
+    mesh = mcdc['mesh_buffer'][get_buffer_idx(), MESH_TRACK]
+    X    = mcdc['X']
+    ux   = P['ux']
+    if ux == 0.0:
+        atomic_add(mesh, P['w']*distance, mesh_bin(x_old, mcdc))
+        return
+
+    x_new = min(max(P['x'], -X), X)
+    x_lo  = min(x_old, x_new)
+    x_hi  = max(x_old, x_new)
+    w_mu  = P['w']/math.fabs(ux)
+    dx    = 2.0*X/mcdc['N_mesh']
+    for i in range(mesh_bin(x_lo, mcdc), mesh_bin(x_hi, mcdc) + 1):
+        a = max(x_lo, -X + i*dx)
+        b = min(x_hi, -X + (i+1)*dx)
+        if b > a:
+            atomic_add(mesh, w_mu*(b - a), i)
+
 def terminate_particle(P):
     P['alive'] = False
     P['w']     = 0.0
     P['event'] = EVENT_NONE
     #sync()
 
+def tally_flush(mcdc, data, b):
+    # Move the caller's buffer into the partial sums of history block b
+    i = get_buffer_idx()
+    for j in range(mcdc['tally'].shape[0]):
+        data.tally_block[b, j]     = mcdc['tally_buffer'][i, j]
+        mcdc['tally_buffer'][i, j] = 0.0
+    for j in range(N_MESH_ESTIMATOR):
+        for k in range(mcdc['N_mesh']):
+            data.mesh_block[b, j, k]     = mcdc['mesh_buffer'][i, j, k]
+            mcdc['mesh_buffer'][i, j, k] = 0.0
+
+def tally_discard(mcdc):
+    # Drop the caller's buffer: the scores of a history block that did not
+    # finish
+    i = get_buffer_idx()
+    for j in range(mcdc['tally'].shape[0]):
+        mcdc['tally_buffer'][i, j] = 0.0
+    for j in range(N_MESH_ESTIMATOR):
+        for k in range(mcdc['N_mesh']):
+            mcdc['mesh_buffer'][i, j, k] = 0.0
+
+def reduce_tally(mcdc, data):
+    # Fold any buffer left (event-based runs score without flushing) into
+    # the first partial sum, then the partial sums into the global tally by a
+    # fixed-order pairwise tree; the result does not depend on the number of
+    # threads
+    N = max(mcdc['N_tally_block'], 1)
+    for i in range(mcdc['N_buffer']):
+        for j in range(mcdc['tally'].shape[0]):
+            data.tally_block[0, j]     += mcdc['tally_buffer'][i, j]
+            mcdc['tally_buffer'][i, j]  = 0.0
+        for j in range(N_MESH_ESTIMATOR):
+            for k in range(mcdc['N_mesh']):
+                data.mesh_block[0, j, k]     += mcdc['mesh_buffer'][i, j, k]
+                mcdc['mesh_buffer'][i, j, k]  = 0.0
+
+    stride = 1
+    while stride < N:
+        for b in range(0, N - stride, 2*stride):
+            for j in range(mcdc['tally'].shape[0]):
+                data.tally_block[b, j]        += \
+                        data.tally_block[b+stride, j]
+                data.tally_block[b+stride, j]  = 0.0
+            for j in range(N_MESH_ESTIMATOR):
+                for k in range(mcdc['N_mesh']):
+                    data.mesh_block[b, j, k]        += \
+                            data.mesh_block[b+stride, j, k]
+                    data.mesh_block[b+stride, j, k]  = 0.0
+        stride *= 2
+
+    for j in range(mcdc['tally'].shape[0]):
+        mcdc['tally'][j]       += data.tally_block[0, j]
+        data.tally_block[0, j]  = 0.0
+    for j in range(N_MESH_ESTIMATOR):
+        for k in range(mcdc['N_mesh']):
+            mcdc['mesh_tally'][j, k] += data.mesh_block[0, j, k]
+            data.mesh_block[0, j, k]  = 0.0
+
 # ==================================
 # Utilities: hardware-specific
 # ==================================
@@ -214,22 +549,131 @@ def CPU_get_idx():
 def GPU_get_idx():
     return cuda.grid(1), cuda.gridsize(1)
 
+# Index of the thread-private buffer (bank and tally) owned by the caller
+get_buffer_idx = None
+def CPU_get_buffer_idx():
+    return 0
+def CPUS_get_buffer_idx():
+    return numba.get_thread_id()
+def GPU_get_buffer_idx():
+    # GPU threads share a single buffer through atomics
+    return 0
+
 create = None
 def CPU_create(dtype):
     return np.zeros(1, dtype=dtype)[0]
 def GPU_create(dtype):
     return cuda.local.array(1, dtype=dtype)[0]
 
+# Scratch for the batch of draws of a source particle
+create_draws = None
+def CPU_create_draws():
+    return np.empty(RNG_SOURCE)
+def GPU_create_draws():
+    return cuda.local.array(RNG_SOURCE, dtype=numba.float64)
+
+# Column-wise exclusive scan of the first N rows of a_in into a_out
 exscan = None
 def CPU_exscan(a_in, a_out, N):
+    a_out[0,:] = 0
     for i in range(N-1):
         a_out[i+1,:] = a_out[i,:] + a_in[i,:]
-# TODO!!!!!!!
-# perform exclusive scan 
+
+def CPUS_exscan(a_in, a_out, N):
+    # Blocked two-pass scan: block totals, scan of the totals, then block-local
+    # scans seeded with the block offsets
+    N_col     = a_in.shape[1]
+    N_block   = numba.get_num_threads()
+    N_row     = (N + N_block - 1) // N_block
+    block_sum = np.zeros((N_block + 1, N_col), dtype=np.int64)
+
+    for b in prange(N_block):
+        for i in range(b*N_row, min((b+1)*N_row, N)):
+            for j in range(N_col):
+                block_sum[b+1, j] += a_in[i, j]
+
+    for b in range(N_block):
+        for j in range(N_col):
+            block_sum[b+1, j] += block_sum[b, j]
+
+    for b in prange(N_block):
+        for j in range(N_col):
+            total = block_sum[b, j]
+            for i in range(b*N_row, min((b+1)*N_row, N)):
+                a_out[i, j] = total
+                total      += a_in[i, j]
+
 def GPU_exscan(a_in, a_out, N):
-    for i in range(N-1):
-        for j in range(a_in.shape[1]):
-            a_out[i+1,j] = a_out[i,j] + a_in[i,j]
+    # Host-side launcher: Blelloch scan per block, recursive scan of the
+    # block totals, then add the block offsets back
+    N_block = (N + EXSCAN_BLOCK - 1) // EXSCAN_BLOCK
+    N_col   = a_in.shape[1]
+    a_block = cuda.device_array((N_block, N_col), dtype=np.int64)
+    exscan_block[N_block, EXSCAN_BLOCK//2](a_in, a_out, a_block, N)
+    if N_block > 1:
+        exscan(a_block, a_block, N_block)
+        exscan_add[N_block, EXSCAN_BLOCK//2](a_out, a_block, N)
+
+exscan_block = None
+def GPU_exscan_block(a_in, a_out, a_block, N):
+    # Work-efficient scan [M. Harris 2007] of EXSCAN_BLOCK rows per block,
+    # two per thread, column by column
+    buff  = cuda.shared.array(EXSCAN_BLOCK, numba.int64)
+    t     = cuda.threadIdx.x
+    b     = cuda.blockIdx.x
+    i_a   = b*EXSCAN_BLOCK + 2*t
+    i_b   = i_a + 1
+    for j in range(a_in.shape[1]):
+        # Load
+        buff[2*t]   = a_in[i_a, j] if i_a < N else 0
+        buff[2*t+1] = a_in[i_b, j] if i_b < N else 0
+
+        # Up-sweep
+        offset = 1
+        d      = EXSCAN_BLOCK >> 1
+        while d > 0:
+            cuda.syncthreads()
+            if t < d:
+                buff[offset*(2*t+2)-1] += buff[offset*(2*t+1)-1]
+            offset <<= 1
+            d      >>= 1
+        cuda.syncthreads()
+
+        # Block total, then clear the last element
+        if t == 0:
+            a_block[b, j]         = buff[EXSCAN_BLOCK-1]
+            buff[EXSCAN_BLOCK-1]  = 0
+
+        # Down-sweep
+        d = 1
+        while d < EXSCAN_BLOCK:
+            offset >>= 1
+            cuda.syncthreads()
+            if t < d:
+                ai       = offset*(2*t+1)-1
+                bi       = offset*(2*t+2)-1
+                tmp      = buff[ai]
+                buff[ai] = buff[bi]
+                buff[bi] += tmp
+            d <<= 1
+        cuda.syncthreads()
+
+        # Store
+        if i_a < N:
+            a_out[i_a, j] = buff[2*t]
+        if i_b < N:
+            a_out[i_b, j] = buff[2*t+1]
+        cuda.syncthreads()
+
+exscan_add = None
+def GPU_exscan_add(a_out, a_block, N):
+    b   = cuda.blockIdx.x
+    i_a = b*EXSCAN_BLOCK + 2*cuda.threadIdx.x
+    for j in range(a_out.shape[1]):
+        if i_a < N:
+            a_out[i_a, j] += a_block[b, j]
+        if i_a + 1 < N:
+            a_out[i_a+1, j] += a_block[b, j]
 
 atomic_add = None
 def GPU_atomic_add(vec, ammount, index):
@@ -246,26 +690,88 @@ def GPU_sync():
 #def GPU_reduction(mcdc, flux):
 #    cuda.ds
 
+# Counters: compiled to no-ops unless the global type has them
+count = None
+def CPU_count(mcdc, idx):
+    mcdc['counter'][get_buffer_idx(), idx] += 1
+def GPU_count(mcdc, idx):
+    cuda.atomic.add(mcdc['counter'], (0, idx), 1)
+def NO_count(mcdc, idx):
+    pass
+
+count_max = None
+def CPU_count_max(mcdc, idx, value):
+    i = get_buffer_idx()
+    if value > mcdc['counter'][i, idx]:
+        mcdc['counter'][i, idx] = value
+def GPU_count_max(mcdc, idx, value):
+    cuda.atomic.max(mcdc['counter'], (0, idx), value)
+def NO_count_max(mcdc, idx, value):
+    pass
+
+def report_counters(mcdc):
+    # Host-side: fold the thread-private counters and print them
+    counter = mcdc['counter'].sum(axis=0)
+    depth   = mcdc['counter'][:, COUNTER_BANK_DEPTH].max()
+    N_source    = max(counter[EVENT_SOURCE], 1)
+    N_collision = counter[EVENT_SCATTERING] + counter[EVENT_FISSION] \
+                  + counter[EVENT_BRANCHLESS_COLLISION] + counter[COUNTER_CAPTURE]
+    print('[COUNTER] source %i, move %i, scattering %i, fission %i, '
+          'leakage %i, branchless collision %i, capture %i'
+          %(counter[EVENT_SOURCE], counter[EVENT_MOVE],
+            counter[EVENT_SCATTERING], counter[EVENT_FISSION],
+            counter[EVENT_LEAKAGE], counter[EVENT_BRANCHLESS_COLLISION],
+            counter[COUNTER_CAPTURE]))
+    print('[COUNTER] collisions per source particle %.3f'
+          %(N_collision/N_source))
+    if mcdc['history_based']:
+        print('[COUNTER] maximum bank depth %i'%depth)
+    else:
+        N_iteration = mcdc['stack_history_size']
+        sizes       = mcdc['stack_history'][:N_iteration]
+        print('[COUNTER] %i event iterations recorded, mean stack sizes %s'
+              %(N_iteration, np.array2string(sizes.mean(axis=0), precision=1)))
+
 # ==================================
 # Utilities: event-based
 # ==================================
 
-def initialize_stack(mcdc, hostco):
-    N_particle = mcdc['stack_'][EVENT_SOURCE]['size']
+def initialize_stack(mcdc, data, hostco):
+    N_particle = mcdc['stack_size'][EVENT_SOURCE]
     start, stride = get_idx()
     for i in range(start, N_particle, stride):
-        mcdc['stack_'][EVENT_SOURCE]['content'][i] = i
+        data.stack[EVENT_SOURCE, i] = i
     
-    N = mcdc['stack_'][EVENT_NONE]['size']
+    N = mcdc['stack_size'][EVENT_NONE]
     start, stride = get_idx()
     for i in range(start, N, stride):
-        mcdc['stack_'][EVENT_NONE]['content'][i] = N_particle + i
+        data.stack[EVENT_NONE, i] = N_particle + i
+
+def fission_count(mcdc):
+    # Host-side, before a fission event: the number of fission neutrons it
+    # will push to the bank, from the first draw of each particle replayed
+    # with the seed the event adapter gives it
+    stack = mcdc['stack_idx'][EVENT_FISSION]
+    N     = mcdc['stack_size'][stack]
+    g, c  = rng_jump(mcdc['event_stride'][EVENT_FISSION], mcdc)
+    P     = create(type_.particle)
+    seed  = mcdc['seed']
+    total = 0
+    for i in range(N):
+        P['seed'] = seed
+        total    += int(math.floor(mcdc['nu'] + rng(P, mcdc)))
+        seed      = rng_advance(seed, g, c, mcdc)
+    return total
 
 # =============================================================================
 # Factory
 # =============================================================================
 
-def make_kernels(alg, target):
+def make_kernels(alg, target, soa_bank=False, rng_type='lcg',
+                 splitting=False, fused=()):
+    # Start over from the Python kernels, in case an earlier call replaced them
+    globals().update(py_functions)
+
     # =========================================================================
     # Functions
     # =========================================================================
@@ -275,58 +781,154 @@ def make_kernels(alg, target):
         target = 'gpu_device'
         fission = async_fission
 
+    # CUDA is only imported for GPU runs
+    global cuda
+    if target in ['gpu', 'gpu_device']:
+        from numba import cuda
+
     sub_target = target
     if target == 'gpu':
         sub_target = 'gpu_device'
+    elif target == 'cpus':
+        # Only the loops are threaded; kernels run serially in each thread
+        sub_target = 'cpu'
 
     # RNG
-    global rng, rng_skip_ahead
-    rng            = adapter.compiler(rng, sub_target)
-    rng_skip_ahead = adapter.compiler(rng_skip_ahead, sub_target)
+    global rng, rng_batch, rng_skip_ahead, rng_jump, rng_advance, threefry
+    if rng_type == 'lcg':
+        rng            = adapter.compiler(LCG_rng, sub_target)
+        rng_batch      = adapter.compiler(LCG_rng_batch, sub_target)
+        rng_skip_ahead = adapter.compiler(LCG_rng_skip_ahead, sub_target)
+        rng_jump       = adapter.compiler(LCG_rng_jump, sub_target)
+    elif rng_type == 'threefry':
+        threefry       = adapter.compiler(threefry, sub_target)
+        rng            = adapter.compiler(THREEFRY_rng, sub_target)
+        rng_batch      = adapter.compiler(THREEFRY_rng_batch, sub_target)
+        rng_skip_ahead = adapter.compiler(THREEFRY_rng_skip_ahead, sub_target)
+        rng_jump       = adapter.compiler(THREEFRY_rng_jump, sub_target)
+    else:
+        print(f"[ERROR] Unrecognized RNG type '{rng_type}'.")
+    rng_advance    = adapter.compiler(rng_advance, sub_target)
     
     # ========================================
     # Utilities
     # ========================================
 
     global read_particle, record_particle, terminate_particle, get_idx, create,\
-           exscan, atomic_add
+           create_draws, exscan, exscan_block, exscan_add, atomic_add,\
+           get_buffer_idx, reduce_tally, tally_flush, tally_discard, mesh_bin,\
+           mesh_track
 
     read_particle   = adapter.compiler(read_particle, sub_target)
     record_particle = adapter.compiler(record_particle, sub_target)
     terminate_particle = adapter.compiler(terminate_particle, sub_target)
-    if target == 'cpu':
-        get_idx = adapter.compiler(CPU_get_idx, target)
-        create  = adapter.compiler(CPU_create, target)
-        exscan  = adapter.compiler(CPU_exscan, target)
-        atomic_add = adapter.compiler(CPU_atomic_add, target)
+    mesh_bin        = adapter.compiler(mesh_bin, sub_target)
+    mesh_track      = adapter.compiler(mesh_track, sub_target)
+    reduce_tally    = adapter.compiler(reduce_tally, 'cpu')
+    tally_flush     = adapter.compiler(tally_flush, sub_target)
+    tally_discard   = adapter.compiler(tally_discard, sub_target)
+    if target in ['cpu', 'cpus']:
+        get_idx = adapter.compiler(CPU_get_idx, sub_target)
+        create  = adapter.compiler(CPU_create, sub_target)
+        create_draws = adapter.compiler(CPU_create_draws, sub_target)
+        atomic_add = adapter.compiler(CPU_atomic_add, sub_target)
+        if target == 'cpu':
+            exscan         = adapter.compiler(CPU_exscan, sub_target)
+            get_buffer_idx = adapter.compiler(CPU_get_buffer_idx, sub_target)
+        else:
+            exscan         = adapter.compiler(CPUS_exscan, target)
+            get_buffer_idx = adapter.compiler(CPUS_get_buffer_idx, sub_target)
     else:
         #! added gpu_device in place of target
+        get_buffer_idx = adapter.compiler(GPU_get_buffer_idx, sub_target)
         get_idx    = adapter.compiler(GPU_get_idx, sub_target)
         create     = adapter.compiler(GPU_create, sub_target)
-        exscan     = adapter.compiler(GPU_exscan, sub_target)
+        create_draws = adapter.compiler(GPU_create_draws, sub_target)
+        exscan       = GPU_exscan
+        exscan_block = adapter.compiler(GPU_exscan_block, 'gpu')
+        exscan_add   = adapter.compiler(GPU_exscan_add, 'gpu')
         atomic_add = adapter.compiler(GPU_atomic_add, sub_target)
         sync       = adapter.compiler(GPU_sync, sub_target)
 
-    global initialize_stack
+    global count, count_max
+
+    if 'counter' not in type_.global_.names:
+        count     = adapter.compiler(NO_count, sub_target)
+        count_max = adapter.compiler(NO_count_max, sub_target)
+    elif target in ['cpu', 'cpus']:
+        count     = adapter.compiler(CPU_count, sub_target)
+        count_max = adapter.compiler(CPU_count_max, sub_target)
+    else:
+        count     = adapter.compiler(GPU_count, sub_target)
+        count_max = adapter.compiler(GPU_count_max, sub_target)
+
+    global bank_read, bank_write, bank_push
+
+    if soa_bank:
+        bank_read  = adapter.compiler(SOA_bank_read, sub_target)
+        bank_write = adapter.compiler(SOA_bank_write, sub_target)
+    else:
+        bank_read  = adapter.compiler(AOS_bank_read, sub_target)
+        bank_write = adapter.compiler(AOS_bank_write, sub_target)
+    bank_push = adapter.compiler(bank_push, sub_target)
 
-    initialize_stack = adapter.compiler(initialize_stack, target)
+    global weight_window, comb_bank
+
+    if alg in [ 'async', 'async-multi', 'new-event', 'new-event-multi' ]:
+        # No runtime buffers to split into
+        weight_window = adapter.compiler(NO_weight_window, sub_target)
+    else:
+        weight_window = adapter.compiler(weight_window, sub_target)
+    comb_bank     = adapter.compiler(comb_bank, sub_target)
+
+    global initialize_stack, fission_count
+
+    if target == 'cpus':
+        initialize_stack = adapter.compiler(initialize_stack, sub_target)
+    else:
+        initialize_stack = adapter.compiler(initialize_stack, target)
+    fission_count = adapter.compiler(fission_count, 'cpu')
     
     # =========================================================================
     # Events
     # =========================================================================
 
     global source, move, leakage, scattering, branchless_collision
+
+    # Fused pairs of events (event-based): both events of a pair run the
+    # fused kernel, made of the particle-level kernels, as a branching event
+    fused_kernels = {}
+    if alg == 'event':
+        P_kernel = {EVENT_MOVE                 : move,
+                    EVENT_SCATTERING           : scattering,
+                    EVENT_BRANCHLESS_COLLISION : branchless_collision,
+                    EVENT_LEAKAGE              : leakage}
+        for first, second in fused:
+            P_first, P_second, P_leak = [adapter.compiler(P_kernel[e], sub_target)
+                                         for e in [first, second, EVENT_LEAKAGE]]
+            fused_kernels[first]  = fused_event(P_first, P_second, P_leak,
+                                                first, second, second)
+            fused_kernels[second] = fused_event(P_first, P_second, P_leak,
+                                                first, second, first)
+    move                 = fused_kernels.get(EVENT_MOVE, move)
+    scattering           = fused_kernels.get(EVENT_SCATTERING, scattering)
+    branchless_collision = fused_kernels.get(EVENT_BRANCHLESS_COLLISION,
+                                             branchless_collision)
+
+    # Splitting makes the collision events, and the fused ones, multiplying
+    naive_move = splitting and EVENT_MOVE in fused_kernels
     
     source                  = adapter.event(source, alg, target, EVENT_SOURCE)
-    move                    = adapter.event(move, alg, target, EVENT_MOVE)#, branching=True)
+    move                    = adapter.event(move, alg, target, EVENT_MOVE, branching=True, naive=naive_move)
     leakage                 = adapter.event(leakage, alg, target, EVENT_LEAKAGE)
-    scattering              = adapter.event(scattering, alg, target, EVENT_SCATTERING)
+    scattering              = adapter.event(scattering, alg, target, EVENT_SCATTERING, branching=EVENT_SCATTERING in fused_kernels, naive=splitting)
     fission                 = adapter.event(fission, alg, target, EVENT_FISSION, naive=True)
-    branchless_collision    = adapter.event(branchless_collision, alg, target, EVENT_BRANCHLESS_COLLISION)
+    branchless_collision    = adapter.event(branchless_collision, alg, target, EVENT_BRANCHLESS_COLLISION, branching=EVENT_BRANCHLESS_COLLISION in fused_kernels, naive=splitting)
 
     
 
-
-
-
-
+# The Python functions of this module, which make_kernels replaces with their
+# compiled versions; restored on each call to build another configuration
+py_functions = {name: value for name, value in globals().items()
+                if callable(value)
+                and getattr(value, '__module__', None) == __name__}
@@ -1,3 +1,4 @@
+import hashlib, multiprocessing, os, time
 import numpy as np
 import type_, kernel, adapter
 
@@ -6,85 +7,160 @@ import adapter
 from adapter import gpu_config
 
 import numba
-from numba import objmode, njit, jit, prange, cuda
+from numba import objmode, njit, jit, prange
+
+cuda = None # numba.cuda, imported by make_loops for GPU runs
 
 from constant import *
 
-simulation = None
+simulation    = None
+history_loop  = None
+schedule      = None
+schedule_name = None
+sort_interval = 0
+fused_events  = set()
 
 # =============================================================================
 # History-based
 # =============================================================================
 
 #@jit(nopython=True)
-def HISTORY_simulation(mcdc, hostco):
+def HISTORY_simulation(mcdc_arr, data, hostco):
+    # The global state comes in as its one-element parent array, as Numba
+    # parallel loops cannot capture records
+
     # =========================================================================
     # Simulation loop
     # =========================================================================
 
-    for i_history in prange(mcdc['N_history']):
-        # =====================================================================
-        # Initialize history
-        # =====================================================================
+    # Each block of histories runs in one thread and keeps its own tally
+    # partial sum. A block whose bank overflows is dropped, to be run again
+    # after the bank grows; the blocks done are kept.
+    N_history  = mcdc_arr[0]['N_history']
+    N_block    = (N_history + TALLY_BLOCK - 1) // TALLY_BLOCK
+    block_done = data.block_done # Unpacked, as the prange body loses writes
+                                 # through tuple fields
+    mcdc_arr[0]['N_tally_block'] = N_block
+    for b in prange(N_block):
+        if block_done[b]:
+            continue
+        done = True
+        for i_history in range(b*TALLY_BLOCK,
+                               min((b+1)*TALLY_BLOCK, N_history)):
+            if not HISTORY_transport(mcdc_arr[0], data, i_history):
+                done = False
+                break
+        if done:
+            kernel.tally_flush(mcdc_arr[0], data, b)
+            block_done[b] = True
+        else:
+            kernel.tally_discard(mcdc_arr[0])
+            mcdc_arr[0]['bank_history_overflow'][kernel.get_buffer_idx()] = 0
+
+def HISTORY_driver(mcdc, data, hostco):
+    # Grow the bank and resume as long as one overflows; only the blocks of
+    # histories that overflowed run again, and results do not change as
+    # history seeds only depend on the history index
+    data.block_done[:] = False
+    history_loop(mcdc, data, hostco)
+    while mcdc['bank_overflow']:
+        size = type_.buffer_size(data)
+        print(f'[INFO] Growing history bank from {size} to {2*size}, resuming.')
+        mcdc['bank_overflow'] = False
+        data = type_.grow_buffers(data, 2*size)
+        history_loop(mcdc, data, hostco)
+
+    # =========================================================================
+    # Closeout
+    # =========================================================================
+
+    kernel.reduce_tally(mcdc, data)
+    return data
+
+def HISTORY_transport(mcdc, data, i_history):
+    # Run one history; False if the bank overflowed, which drops it
+
+    # =========================================================================
+    # Initialize history
+    # =========================================================================
+
+    # Thread-private bank
+    i_buffer = kernel.get_buffer_idx()
+    bank     = data.bank_history[i_buffer]
+    size     = mcdc['bank_history_size']
+
+    # Create particle
+    P = kernel.create(type_.particle)
 
-        # Create particle
-        P = kernel.create(type_.particle)
+    # Set RNG seed (depends on the history index only, so that histories
+    # can run in any order and thread)
+    P['seed'] = mcdc['seed']
+    kernel.rng_skip_ahead((mcdc['history_offset'] + i_history)
+                          *mcdc['history_stride'], P, mcdc)
 
-        # Set RNG seed
-        P['seed'] = mcdc['seed']
-        kernel.rng_skip_ahead(i_history*mcdc['history_stride'], P, mcdc)
+    # Initialize particle
+    kernel.source(P, mcdc, data)
+    
+    # "Push" to the bank
+    bank[0]          = kernel.record_particle(P)
+    size[i_buffer]   = 1
+
+    # History seed
+    seed = P['seed']
+
+    # =========================================================================
+    # History loop
+    # =========================================================================
 
+    while size[i_buffer] > 0:
+        # =====================================================================
         # Initialize particle
-        kernel.source(P, mcdc)
-        
-        # "Push" to the bank
-        mcdc['bank']['content'][0] = kernel.record_particle(P)
-        mcdc['bank']['size']       = 1
+        # =====================================================================
 
-        # Reset main seed
-        mcdc['seed'] = P['seed']
+        # "Pop" particle from bank
+        size[i_buffer] -= 1
+        idx = size[i_buffer]
+        P = kernel.read_particle(bank[idx])
+
+        # Set particle seed
+        P['seed'] = seed
 
         # =====================================================================
-        # History loop
+        # Particle loop
         # =====================================================================
 
-        while mcdc['bank']['size'] > 0:
-            # =================================================================
-            # Initialize particle
-            # =================================================================
+        # Particle loop
+        while P['alive']:
+            # Move to event
+            kernel.move(P, mcdc, data)
 
-            # "Pop" particle from bank
-            mcdc['bank']['size'] -= 1
-            idx = mcdc['bank']['size']
-            P = kernel.read_particle(mcdc['bank']['content'][idx])
+            # Event
+            event = P['event']
 
-            # Set particle seed
-            P['seed'] = mcdc['seed']
+            # Collision
+            if event == EVENT_SCATTERING:
+                kernel.scattering(P, mcdc, data)
+            elif event == EVENT_FISSION:
+                kernel.fission(P, mcdc, data)
+            elif event == EVENT_LEAKAGE:
+                kernel.leakage(P, mcdc, data)
+            elif event == EVENT_BRANCHLESS_COLLISION:
+                kernel.branchless_collision(P, mcdc, data)
 
-            # =================================================================
-            # Particle loop
-            # =================================================================
+        # Secondaries were lost to a full bank; drop the history
+        if mcdc['bank_history_overflow'][i_buffer] != 0:
+            return False
 
-            # Particle loop
-            while P['alive']:
-                # Move to event
-                kernel.move(P, mcdc)
+        # Bank depth right after the particle's secondaries are pushed
+        kernel.count_max(mcdc, COUNTER_BANK_DEPTH, size[i_buffer])
 
-                # Event
-                event = P['event']
+        # Population control
+        kernel.comb_bank(P, mcdc, data)
 
-                # Collision
-                if event == EVENT_SCATTERING:
-                    kernel.scattering(P, mcdc)
-                elif event == EVENT_FISSION:
-                    kernel.fission(P, mcdc)
-                elif event == EVENT_LEAKAGE:
-                    kernel.leakage(P, mcdc)
-                elif event == EVENT_BRANCHLESS_COLLISION:
-                    kernel.branchless_collision(P, mcdc)
+        # Update history seed
+        seed = P['seed']
 
-            # Update main seed
-            mcdc['seed'] = P['seed']
+    return True
 
 # =============================================================================
 # Event-based
@@ -92,7 +168,7 @@ def HISTORY_simulation(mcdc, hostco):
 
 #init_stack = None
 
-def EVENT_simulation(mcdc, hostco):
+def EVENT_simulation(mcdc, data, hostco):
     # =========================================================================
     # Initialize simulation
     # =========================================================================
@@ -103,73 +179,351 @@ def EVENT_simulation(mcdc, hostco):
     #else:
     #!kernel.initialize_stack(mcdc, hostco)
     
-    #b,t = adapter.gpu_config(mcdc['N_particle'], hostco)
-    b,t = adapter.gpu_config(int(1E6), hostco)
-    gpu_hostco = cuda.to_device(hostco)
-    gpu_mcdc   = cuda.to_device(mcdc)
-    kernel.initialize_stack[b,t](gpu_mcdc, gpu_hostco)
+    # A restarted batch continues from its checkpointed stacks
+    resume = progress['iteration'] > 0
+
+    if mcdc['gpu']:
+        #b,t = adapter.gpu_config(mcdc['N_particle'], hostco)
+        b,t = adapter.gpu_config(int(1E6), hostco)
+        gpu_hostco = cuda.to_device(hostco)
+        gpu_mcdc, gpu_data = to_device(mcdc, data)
+        if not resume:
+            kernel.initialize_stack[b,t](gpu_mcdc, gpu_data, gpu_hostco)
+    else:
+        # No device copies on CPU
+        gpu_hostco = hostco
+        gpu_mcdc   = mcdc
+        gpu_data   = data
+        if not resume:
+            kernel.initialize_stack(mcdc, data, hostco)
         
     # =========================================================================
     # Simulation loop
     # =========================================================================
     #print('To simulation')
-    it = 0
+    it        = 0
+    occupancy = 0
+    stack     = EVENT_NONE
+    if resume:
+        it        = progress['iteration']
+        occupancy = progress['occupancy']
+        stack     = progress['stack']
+    counters  = 'counter' in mcdc.dtype.names
+    stack_history = []
+    sort_stats    = []
     while np.max(hostco['stack_size'][1:]) > 0:
+        # Snapshot between iterations
+        progress['iteration'] = it
+        progress['occupancy'] = occupancy
+        progress['stack']     = stack
+        checkpoint(mcdc, data, gpu_mcdc, gpu_data)
+
         it += 1
         #print(it)
         # =====================================================================
         # Initialize event
         # =====================================================================
     
-        # Determine next event executed based on the longest stack
+        # Renumber the bank to follow the stacks
+        if sort_interval > 0 and it % sort_interval == 0:
+            stats = EVENT_sort(mcdc, gpu_mcdc, data, gpu_data)
+            sort_stats.append(stats)
+
         #gpu_hostco.copy_to_host(hostco)
-        stack = np.argmax(hostco['stack_size'][1:]) + 1 # Offset for EVENT_NONE
-        event = hostco['event_idx'][stack]
+        # Determine next event executed based on the scheduling policy
+        stack      = schedule(hostco, mcdc, stack)
+        event      = hostco['event_idx'][stack]
+        occupancy += hostco['stack_size'][stack]
+
+        # Stack-size history (stored after the device copy comes back)
+        if counters:
+            stack_history.append(hostco['stack_size'].copy())
 
         #print(event)
 
+        # Make room in the bank for the secondaries of a multiplying event
+        N_new = 0
+        if event == EVENT_FISSION:
+            if mcdc['gpu']:
+                gpu_mcdc.copy_to_host(mcdc)
+            N_new = kernel.fission_count(mcdc)
+        elif (event in [EVENT_SCATTERING, EVENT_BRANCHLESS_COLLISION]
+              or event in fused_events) and mcdc['weight_window']:
+            N_new = EVENT_split_count(mcdc, data, stack)
+        if hostco['stack_size'][EVENT_NONE] < N_new:
+            data, gpu_data = EVENT_grow_bank(mcdc, gpu_mcdc, data, gpu_data,
+                                             hostco, N_new)
+
+        # Population control
+        if event == EVENT_MOVE and mcdc['comb']:
+            EVENT_comb(mcdc, data, hostco, stack)
+
         # =================================================================
         # Event loop
         # =================================================================
         
         if event == EVENT_SOURCE:
             #print('Source! {}'.format(event))
-            kernel.source(mcdc, gpu_mcdc, hostco, gpu_hostco)
+            kernel.source(mcdc, gpu_mcdc, data, gpu_data, hostco, gpu_hostco)
         elif event == EVENT_MOVE:
             #print('Move! {}'.format(event))
-            kernel.move(mcdc, gpu_mcdc, hostco,  gpu_hostco)
+            kernel.move(mcdc, gpu_mcdc, data, gpu_data, hostco, gpu_hostco)
         elif event == EVENT_SCATTERING:
             #print('Scattering! {}'.format(event))
-            kernel.scattering(mcdc, gpu_mcdc, hostco, gpu_hostco)
+            kernel.scattering(mcdc, gpu_mcdc, data, gpu_data, hostco,
+                              gpu_hostco)
         elif event == EVENT_FISSION:
             #print('Fission! {}'.format(event))
-            kernel.fission(mcdc, gpu_mcdc, hostco, gpu_hostco)
+            kernel.fission(mcdc, gpu_mcdc, data, gpu_data, hostco, gpu_hostco)
         elif event == EVENT_LEAKAGE:
             #print('Leak! {}'.format(event))
-            kernel.leakage(mcdc, gpu_mcdc, hostco, gpu_hostco)
+            kernel.leakage(mcdc, gpu_mcdc, data, gpu_data, hostco, gpu_hostco)
         elif event == EVENT_BRANCHLESS_COLLISION:
             #print('Branchless Collision!', event)
-            kernel.branchless_collision(mcdc, gpu_mcdc, hostco, gpu_hostco)
+            kernel.branchless_collision(mcdc, gpu_mcdc, data, gpu_data, hostco,
+                                        gpu_hostco)
 
 
         '''
         print(hostco['stack_size'])
-        print(mcdc['stack_']['size'])
+        print(mcdc['stack_size'])
         for i in range(hostco['stack_size'].shape[0]):
-            size = mcdc['stack_'][i]['size']
+            size = mcdc['stack_size'][i]
             if size > 0:
-                print(i, size, mcdc['stack_'][i]['content'][:size])
-        print(mcdc['bank'])
+                print(i, size, data.stack[i, :size])
+        print(data.bank)
         print('\n\n')
         '''
 
+    print(f'[INFO] Schedule {schedule_name}: {it} event iterations, '
+          f'mean stack occupancy {occupancy/max(it, 1):.1f}')
+    if sort_stats:
+        # Totals over the sorts of (reads, unit strides, sum of |strides|)
+        before, after = np.maximum(np.sum(sort_stats, axis=0), 1)
+        print(f'[INFO] Bank sort ({len(sort_stats)}x): unit-stride reads '
+              f'{before[1]/before[0]:.3f} -> {after[1]/after[0]:.3f}, '
+              f'mean |stride| {before[2]/before[0]:.1f} -> '
+              f'{after[2]/after[0]:.1f}')
+
+    if mcdc['gpu']:
+        to_host(mcdc, gpu_mcdc, data, gpu_data)
+    if counters:
+        for sizes in stack_history:
+            i = mcdc['stack_history_size']
+            if i == STACK_HISTORY_SIZE:
+                break
+            mcdc['stack_history'][i]    = sizes
+            mcdc['stack_history_size'] += 1
+    if mcdc['bank_overflow']:
+        print('[ERROR] Event bank overflow; particles were lost.')
+    kernel.reduce_tally(mcdc, data)
+    progress['iteration'] = 0
+    return data
+
+def EVENT_grow_bank(mcdc, gpu_mcdc, data, gpu_data, hostco, N_new):
+    # Grow the bank (and stacks) so that at least N_new slots are idle; the
+    # buffers are passed next to the global record, so nothing recompiles
+    if mcdc['gpu']:
+        to_host(mcdc, gpu_mcdc, data, gpu_data)
+
+    size_old = type_.buffer_size(data)
+    N_idle   = mcdc['stack_size'][EVENT_NONE]
+    size_new = max(2*size_old, size_old + N_new - N_idle)
+    print(f'[INFO] Growing event bank from {size_old} to {size_new}.')
+    data = type_.grow_buffers(data, size_new)
+
+    # The new slots are idle
+    data.stack[EVENT_NONE, N_idle:N_idle+size_new-size_old] = \
+        np.arange(size_old, size_new)
+    mcdc['stack_size'][EVENT_NONE]  += size_new - size_old
+    hostco['stack_size'][EVENT_NONE] = mcdc['stack_size'][EVENT_NONE]
+
+    if mcdc['gpu']:
+        cuda.to_device(mcdc, to=gpu_mcdc)
+        _, gpu_data = to_device(mcdc, data)
+    else:
+        gpu_data = data
+    return data, gpu_data
+
+def to_device(mcdc, data):
+    # Device copies of the global record and the runtime buffers
+    return (cuda.to_device(mcdc),
+            type_.Buffers(*[cuda.to_device(a) for a in data]))
+
+def to_host(mcdc, gpu_mcdc, data, gpu_data):
     gpu_mcdc.copy_to_host(mcdc)
+    for a, gpu_a in zip(data, gpu_data):
+        gpu_a.copy_to_host(a)
+
+def EVENT_sort(mcdc, gpu_mcdc, data, gpu_data):
+    # Renumber the bank slots in stack order (active stacks, then the idle
+    # one), so that each stack reads a contiguous range of the bank. The
+    # stacks keep their order, and with it the RNG seeds of their particles.
+    if mcdc['gpu']:
+        to_host(mcdc, gpu_mcdc, data, gpu_data)
+    before = stack_strides(mcdc, data)
+
+    N_stack = mcdc['N_stack']
+    order   = [data.stack[stack, :mcdc['stack_size'][stack]]
+               for stack in list(range(1, N_stack)) + [EVENT_NONE]]
+    perm    = np.concatenate(order)
+
+    fields = bank_fields(data)
+    if perm.shape[0] != fields[0].shape[0]:
+        # Lost particles (bank overflow); leave the bank as is
+        return (before, before)
+
+    for field in fields:
+        field[:] = field[perm]
+    start = 0
+    for stack, content in zip(list(range(1, N_stack)) + [EVENT_NONE], order):
+        size = content.shape[0]
+        data.stack[stack, :size] = np.arange(start, start+size)
+        start += size
+
+    if mcdc['gpu']:
+        for a, gpu_a in zip(data, gpu_data):
+            gpu_a.copy_to_device(a)
+    return (before, stack_strides(mcdc, data))
+
+def bank_fields(data):
+    # Host-side views of the event bank records (AoS) or fields (SoA)
+    bank = data.bank
+    if bank.dtype.names is not None:
+        return [bank]
+    else:
+        return [bank[0], bank[1], bank[2]]
+
+def bank_weight(data):
+    bank = data.bank
+    if bank.dtype.names is not None:
+        return bank['w']
+    else:
+        return bank[2]
+
+def EVENT_split_count(mcdc, data, stack):
+    # Number of particles the weight window splitting of a collision event
+    # adds, from the weights after the collision (for fused events, an upper
+    # bound assuming every particle collides)
+    factor = 1.0
+    if mcdc['branchless_collision']:
+        factor = (mcdc['SigmaS'] + mcdc['nu']*mcdc['SigmaF'])/mcdc['SigmaT']
+    size = mcdc['stack_size'][stack]
+    w    = bank_weight(data)[data.stack[stack, :size]]*factor
+    w    = w[w > mcdc['ww_high']]
+    n    = np.minimum(np.ceil(w/mcdc['ww_high']), WW_SPLIT_MAX)
+    return int(np.sum(n - 1))
+
+def EVENT_comb(mcdc, data, hostco, stack):
+    # Comb the move stack down to the source population when it holds more,
+    # as kernel.comb_bank does for a history bank. The first copy of a
+    # particle keeps its bank slot, the others take idle slots, and the
+    # slots of the particles not picked become idle. The offset draw comes
+    # off the main seed.
+    size = mcdc['stack_size'][stack]
+    M    = mcdc['N_particle']
+    if size <= M:
+        return
+
+    slots = data.stack[stack, :size].copy()
+    w     = bank_weight(data)
+    W     = np.sum(w[slots])
+
+    P         = np.zeros(1, dtype=type_.particle)[0]
+    P['seed'] = mcdc['seed']
+    xi        = kernel.rng(P, mcdc)
+    mcdc['seed'] = P['seed']
+
+    # Particle of each tooth
+    teeth = (xi + np.arange(M))*(W/M)
+    pick  = np.searchsorted(np.cumsum(w[slots]), teeth, side='right')
+    pick  = np.minimum(pick, size - 1)
+    first = np.ones(M, dtype=bool)
+    first[1:] = pick[1:] != pick[:-1]
+
+    # Release the slots of the particles not picked, then take the ones for
+    # the extra copies
+    idle   = data.stack[EVENT_NONE]
+    picked = np.zeros(size, dtype=bool)
+    picked[pick] = True
+    dead   = slots[~picked]
+    N_idle = mcdc['stack_size'][EVENT_NONE]
+    idle[N_idle:N_idle+dead.shape[0]] = dead
+    N_idle += dead.shape[0] - np.count_nonzero(~first)
+    extra   = idle[N_idle:N_idle+np.count_nonzero(~first)].copy()
+    mcdc['stack_size'][EVENT_NONE] = N_idle
+
+    content = data.stack[stack]
+    content[:M][first]  = slots[pick[first]]
+    content[:M][~first] = extra
+    for field in bank_fields(data):
+        field[extra] = field[slots[pick[~first]]]
+    w[content[:M]] = W/M
+
+    mcdc['stack_size'][stack]        = M
+    hostco['stack_size'][stack]      = M
+    hostco['stack_size'][EVENT_NONE] = N_idle
+
+def stack_strides(mcdc, data):
+    # Cache-miss proxy: the number of consecutive bank reads of the active
+    # stacks, how many of them have a unit stride, and the sum of the strides
+    N_read = 0
+    N_unit = 0
+    total  = 0
+    for stack in range(1, mcdc['N_stack']):
+        size   = mcdc['stack_size'][stack]
+        stride = np.abs(np.diff(data.stack[stack, :size]))
+        N_read += stride.shape[0]
+        N_unit += np.count_nonzero(stride == 1)
+        total  += np.sum(stride)
+    return (N_read, N_unit, total)
+
+# =============================================================================
+# Event scheduling policies
+# =============================================================================
+# Pick the stack to run next from the host-side stack sizes, given the one
+# run last (EVENT_NONE at the start)
+
+def SCHEDULE_largest(hostco, mcdc, last):
+    # The longest stack
+    return np.argmax(hostco['stack_size'][1:]) + 1 # Offset for EVENT_NONE
+
+def SCHEDULE_round_robin(hostco, mcdc, last):
+    # The next non-empty stack in a fixed cyclic order
+    N_stack = hostco['stack_size'].shape[0]
+    for k in range(1, N_stack):
+        stack = (last + k - 1) % (N_stack - 1) + 1
+        if hostco['stack_size'][stack] > 0:
+            return stack
+    return last
+
+def SCHEDULE_threshold(hostco, mcdc, last):
+    # Cyclic over the stacks holding a minimum share of the source particles,
+    # so that small stacks wait to fill up; the longest if none does
+    N_min   = max(1, int(SCHEDULE_OCCUPANCY*mcdc['N_particle']))
+    N_stack = hostco['stack_size'].shape[0]
+    for k in range(1, N_stack):
+        stack = (last + k - 1) % (N_stack - 1) + 1
+        if hostco['stack_size'][stack] >= N_min:
+            return stack
+    return SCHEDULE_largest(hostco, mcdc, last)
+
+def SCHEDULE_drain_tail(hostco, mcdc, last):
+    # The longest stack until few particles are left, then cyclic, which
+    # moves every remaining particle once per sweep
+    if np.sum(hostco['stack_size'][1:]) < SCHEDULE_TAIL*mcdc['N_particle']:
+        return SCHEDULE_round_robin(hostco, mcdc, last)
+    return SCHEDULE_largest(hostco, mcdc, last)
 
 path_to_harmonize='../harmonize'
-import sys
-sys.path.append(path_to_harmonize)
-import harmonize as harm
+harm = None
 def ASYNC_simulation_factory(single_fn=True, asynchronous=True):
+    # Harmonize is only needed (and imported) for the async algorithms
+    global harm
+    import sys
+    if path_to_harmonize not in sys.path:
+        sys.path.append(path_to_harmonize)
+    import harmonize as harm
 
     dev_state_type = numba.from_dtype(type_.global_)
     grp_state_type = numba.from_dtype(np.dtype([ ]))
@@ -200,19 +554,19 @@ def ASYNC_simulation_factory(single_fn=True, asynchronous=True):
 
 
     def source(prog: numba.uintp, P: particle):
-        kernel.source(P, device(prog))
+        kernel.source(P, device(prog), None)
         continuation(prog,P)
     
     def move(prog: numba.uintp, P: particle):
-        kernel.move(P, device(prog))
+        kernel.move(P, device(prog), None)
         continuation(prog,P)
         
     def scattering(prog: numba.uintp, P: particle):
-        kernel.scattering(P, device(prog))
+        kernel.scattering(P, device(prog), None)
         continuation(prog,P)
         
     def fission(prog: numba.uintp, P: particle):
-        n = kernel.fission(P, device(prog))
+        n = kernel.fission(P, device(prog), None)
         for i in range(n):
             P_new       = numba.cuda.local.array(1,particle)[0]
             P_new['x']  = P['x']
@@ -225,23 +579,23 @@ def ASYNC_simulation_factory(single_fn=True, asynchronous=True):
         kernel.terminate_particle(P)
         
     def leakage(prog: numba.uintp, P: particle):
-        kernel.leakage(P, device(prog))
+        kernel.leakage(P, device(prog), None)
         continuation(prog,P)
         
     def bcollision(prog: numba.uintp, P: particle):
-        kernel.branchless_collision(P, device(prog))
+        kernel.branchless_collision(P, device(prog), None)
         continuation(prog,P)
 
 
     def iterate(prog: numba.uintp, P: particle):
         if   P['event'] == EVENT_SOURCE:
-            kernel.source(P, device(prog))
+            kernel.source(P, device(prog), None)
         elif P['event'] == EVENT_MOVE:
-            kernel.move(P, device(prog))
+            kernel.move(P, device(prog), None)
         elif P['event'] == EVENT_SCATTERING:
-            kernel.scattering(P, device(prog))
+            kernel.scattering(P, device(prog), None)
         elif P['event'] == EVENT_FISSION:
-            n = kernel.fission(P, device(prog))
+            n = kernel.fission(P, device(prog), None)
             for i in range(n):
                 P_new       = numba.cuda.local.array(1,particle)[0]
                 P_new['x']  = P['x']
@@ -253,9 +607,9 @@ def ASYNC_simulation_factory(single_fn=True, asynchronous=True):
                 iterate_async(prog,P_new)
             kernel.terminate_particle(P)
         elif P['event'] == EVENT_LEAKAGE:
-            kernel.leakage(P, device(prog))
+            kernel.leakage(P, device(prog), None)
         elif P['event'] == EVENT_BRANCHLESS_COLLISION:
-            kernel.branchless_collision(P, device(prog))
+            kernel.branchless_collision(P, device(prog), None)
 
         if   P['event'] != EVENT_NONE:
             iterate_async(prog,P)
@@ -316,7 +670,9 @@ def ASYNC_simulation_factory(single_fn=True, asynchronous=True):
     else:
         runtime = program_spec.event_instance(io_capacity=65536*4,load_margin=1024)
 
-    def runner(mcdc,hostco):
+    def runner(mcdc, data, hostco):
+        # The kernels only use the runtime buffers to bank secondaries, which
+        # the async runtime spawns as work instead
         runtime.init(256)
         runtime.store_state(mcdc)
         if asynchronous:
@@ -324,6 +680,8 @@ def ASYNC_simulation_factory(single_fn=True, asynchronous=True):
         else:
             runtime.exec(4,1024)
         runtime.load_state(mcdc)
+        kernel.reduce_tally(mcdc, data)
+        return data
 
     return runner
 
@@ -332,16 +690,373 @@ def ASYNC_simulation_factory(single_fn=True, asynchronous=True):
 
 
 
+# =============================================================================
+# Batched source
+# =============================================================================
+
+def batch_setup(mcdc, data, hostco, offset, N):
+    # Source N particles, starting at history offset (history-based)
+    if mcdc['history_based']:
+        mcdc['history_offset'] = offset
+        mcdc['N_history']      = N
+    else:
+        mcdc['N_particle'] = N
+
+        # Seed from the batch offset, as for history-based batches, so that a
+        # batch draws the same numbers however the batches are run (host-side
+        # seed jumps, as the compiled ones may be GPU device functions)
+        rng_jump    = getattr(kernel.rng_jump, 'py_func', kernel.rng_jump)
+        rng_advance = getattr(kernel.rng_advance, 'py_func',
+                              kernel.rng_advance)
+        g, c = rng_jump(offset*mcdc['history_stride'], mcdc)
+        mcdc['seed'] = rng_advance(mcdc['seed_start'], g, c, mcdc)
+
+        # Fresh stacks; initialize_stack refills their content
+        mcdc['stack_size'][:]            = 0
+        mcdc['stack_size'][EVENT_SOURCE] = N
+        mcdc['stack_size'][EVENT_NONE]   = data.stack.shape[1] - N
+        hostco['stack_size'] = mcdc['stack_size']
+
+def batch_simulation(mcdc, data, hostco, N_particle, N_batch, rel_error=0.0):
+    # Run N_particle source particles in batches of at most N_batch, reusing
+    # the state allocated for a single batch. Tallies accumulate across
+    # batches. Seeds start from the batch offset (see batch_setup), so
+    # history-based results match an unbatched run, and event-based ones
+    # match an MPI run with the same N_batch.
+    #
+    # The per-particle tally of each batch feeds an online (Welford) mean
+    # and variance. With a target rel_error, the run stops once the relative
+    # error of every non-zero tally reaches it; N_particle is then the cap.
+    #
+    # Runs restarted from a checkpoint (see restart) skip the batches done,
+    # and pick up the statistics from there; a run restarted from the final
+    # checkpoint of a finished one returns its results as they are.
+    if progress['done']:
+        progress.base[:] = np.zeros(1, dtype=progress_type)
+        return data
+
+    start   = None # From the end of the first batch run, which compiles
+    N_timed = 0
+    mean  = progress['mean'].copy()
+    M2    = progress['M2'].copy()
+    progress['N_batch'] = N_batch
+    for i_batch, offset in enumerate(range(0, N_particle, N_batch)):
+        if i_batch < progress['i_batch']:
+            continue
+        N = min(N_batch, N_particle - offset)
+        if progress['iteration'] == 0:
+            batch_setup(mcdc, data, hostco, offset, N)
+            progress['tally_start'] = mcdc['tally']
+
+        data = simulation(mcdc, data, hostco)
+        mcdc['N_source'] += N
+        if start is None:
+            start = time.perf_counter()
+        else:
+            N_timed += 1
+
+        # Batch statistics
+        score  = (mcdc['tally'] - progress['tally_start'])/N
+        delta  = score - mean
+        mean  += delta/(i_batch + 1)
+        M2    += delta*(score - mean)
+        progress['i_batch'] = i_batch + 1
+        progress['mean']    = mean
+        progress['M2']      = M2
+        if i_batch > 0:
+            std = np.sqrt(M2/i_batch/(i_batch + 1))
+            mcdc['tally_rel_error'] = np.divide(std, np.abs(mean),
+                                                out=np.zeros_like(std),
+                                                where=mean != 0.0)
+            R = np.max(mcdc['tally_rel_error'])
+            if rel_error > 0.0 and i_batch + 1 >= CONVERGENCE_MIN_BATCH \
+               and R <= rel_error:
+                break
+        checkpoint(mcdc, data)
+
+    # The run is complete (all batches run, or converged); later runs start
+    # afresh
+    progress['done'] = True
+    checkpoint(mcdc, data, force=True)
+    progress.base[:] = np.zeros(1, dtype=progress_type)
+
+    # Figure of merit, 1/(R^2 T), with T the time of all the batches at the
+    # rate of the ones timed (the first one run, with the compilation, is not)
+    if rel_error > 0.0 and N_timed > 0:
+        T = (time.perf_counter() - start)/N_timed*(i_batch + 1)
+        R = np.max(mcdc['tally_rel_error'])
+        print(f"[INFO] {mcdc['N_source']} particles in {i_batch + 1} "
+              f"batches, relative error {R:.3e}, "
+              f"FOM {1.0/(R*R*T) if R > 0.0 else np.inf:.3e} "
+              f"(timed after the first batch)")
+    return data
+
+# =============================================================================
+# Checkpoint and restart
+# =============================================================================
+# A checkpoint file holds the progress record below followed by the global
+# state and the runtime buffers, all written straight from their memory.
+# Batched runs write one after each batch and, in event mode, between event
+# iterations, at most every checkpoint_interval seconds (and always at the
+# end, marked done). A run restarted from it continues from the batch (and
+# event iteration) it was in, with the same results as an uninterrupted run.
+
+progress_type = np.dtype([('magic', 'S8'), ('layout', 'S16'),
+                          ('bank_size', np.int64), ('N_batch', np.int64),
+                          # Batches done, and in the current batch the event
+                          # iterations done and the scheduler state
+                          ('i_batch', np.int64), ('iteration', np.int64),
+                          ('occupancy', np.int64), ('stack', np.int64),
+                          # Tally at the start of the current batch, and the
+                          # batch statistics
+                          ('tally_start', np.float64, (3,)),
+                          ('mean', np.float64, (3,)),
+                          ('M2', np.float64, (3,)),
+                          # Run complete: all batches run, or converged
+                          ('done', np.bool_)])
+progress = np.zeros(1, dtype=progress_type)[0]
+
+checkpoint_file     = None
+checkpoint_interval = 0.0
+checkpoint_time     = 0.0
+
+def set_checkpoint(path, interval):
+    global checkpoint_file, checkpoint_interval, checkpoint_time
+    checkpoint_file     = path
+    checkpoint_interval = interval
+    checkpoint_time     = time.perf_counter()
+
+def layout_key(data):
+    # The global type and the buffer types, which pin the configuration a
+    # checkpoint is good for
+    key = repr(type_.global_.descr) + repr([(a.dtype.descr, a.ndim)
+                                            for a in data])
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+def checkpoint(mcdc, data, gpu_mcdc=None, gpu_data=None, force=False):
+    # Write a checkpoint if one is due; the file is replaced atomically
+    global checkpoint_time
+    if checkpoint_file is None:
+        return
+    now = time.perf_counter()
+    if not force and now - checkpoint_time < checkpoint_interval:
+        return
+    checkpoint_time = now
+
+    if mcdc['gpu'] and gpu_mcdc is not None:
+        to_host(mcdc, gpu_mcdc, data, gpu_data)
+    progress['magic']     = CHECKPOINT_MAGIC
+    progress['layout']    = layout_key(data)
+    progress['bank_size'] = type_.buffer_size(data)
+
+    path = checkpoint_file + '.tmp'
+    with open(path, 'wb') as f:
+        progress.base.tofile(f)
+        mcdc.base.tofile(f)
+        for a in data:
+            a.tofile(f)
+    os.replace(path, checkpoint_file)
+
+def restart(path, N_batch):
+    # Global state, runtime buffers (allocated for the bank size they were
+    # written with), and progress from a checkpoint; None if it does not
+    # match this configuration. The progress is only taken once the
+    # checkpoint passes the checks, so that a failed restart leaves no trace.
+    saved = np.zeros(1, dtype=progress_type)[0]
+    with open(path, 'rb') as f:
+        f.readinto(saved.base.view(np.uint8))
+        if saved['magic'] != CHECKPOINT_MAGIC:
+            print(f"[ERROR] '{path}' is not a checkpoint file.")
+            return None
+        if saved['N_batch'] != N_batch:
+            print(f"[ERROR] Checkpoint was written with N_batch {saved['N_batch']}.")
+            return None
+
+        data = type_.allocate_buffers(N_batch, int(saved['bank_size']))
+        if saved['layout'] != layout_key(data).encode():
+            print(f"[ERROR] Checkpoint '{path}' was written by a different configuration.")
+            return None
+
+        state = type_.allocate_global()
+        f.readinto(state.view(np.uint8))
+        for a in data:
+            f.readinto(a.view(np.uint8))
+    progress.base[:] = saved.base
+
+    if progress['done']:
+        print(f"[INFO] Restarting from '{path}': run complete, "
+              f"{progress['i_batch']} batches.")
+    else:
+        print(f"[INFO] Restarting from '{path}': batch {progress['i_batch']}, "
+              f"event iteration {progress['iteration']}.")
+    return state[0], data
+
+# =============================================================================
+# Multi-process history-based
+# =============================================================================
+# Forked workers run chunks of histories (seeded from the chunk offset) on
+# their own copy of the state, and write the chunk tallies into a shared
+# matrix. The chunks are summed in order, as batch_simulation does with
+# N_batch = N_chunk, so results match that serial run bit for bit.
+
+pool_state  = None # Worker's [mcdc, data, hostco]
+pool_result = None # Worker's view of the shared chunk tallies
+
+def pool_initialize(mcdc_init, data_init, hostco_init, shared, N_col):
+    global pool_state, pool_result
+    pool_state  = [mcdc_init.copy()[0],
+                   type_.Buffers(*[a.copy() for a in data_init]),
+                   hostco_init.copy()[0]]
+    pool_result = np.frombuffer(shared).reshape(-1, N_col)
+
+def pool_run(chunk):
+    i_chunk, offset, N = chunk
+    mcdc, data, hostco = pool_state
+
+    mcdc['history_offset'] = offset
+    mcdc['N_history']      = N
+    mcdc['tally']          = 0.0
+    mcdc['mesh_tally']     = 0.0
+    pool_state[1] = simulation(mcdc, data, hostco) # May have been grown
+
+    pool_result[i_chunk, :3] = mcdc['tally']
+    pool_result[i_chunk, 3:] = mcdc['mesh_tally'].ravel()
+    return i_chunk
+
+def pool_simulation(mcdc, data, hostco, N_particle, N_chunk, N_process):
+    chunks = [(i, offset, min(N_chunk, N_particle - offset))
+              for i, offset in enumerate(range(0, N_particle, N_chunk))]
+    N_col  = 3 + N_MESH_ESTIMATOR*int(mcdc['N_mesh'])
+    shared = multiprocessing.RawArray('d', len(chunks)*N_col)
+
+    # Compile with an empty run first, so that the workers inherit the
+    # kernels instead of each compiling them
+    mcdc_warm = mcdc.base.copy()[0]
+    mcdc_warm['N_history'] = 0
+    simulation(mcdc_warm, type_.Buffers(*[a.copy() for a in data]),
+               hostco.base.copy()[0])
+
+    # Workers are reused across chunks, which are handed out one at a time as
+    # history lengths vary
+    context = multiprocessing.get_context('fork')
+    with context.Pool(N_process, initializer=pool_initialize,
+                      initargs=(mcdc.base, data, hostco.base, shared,
+                                N_col)) as pool:
+        for i_chunk in pool.imap_unordered(pool_run, chunks):
+            pass
+
+    result = np.frombuffer(shared).reshape(-1, N_col)
+    for row in result:
+        mcdc['tally']      += row[:3]
+        mcdc['mesh_tally'] += row[3:].reshape(N_MESH_ESTIMATOR, -1)
+    mcdc['N_source'] += N_particle
+    return data
+
+# =============================================================================
+# MPI
+# =============================================================================
+# Ranks pull batch indices from a counter on rank 0 (one-sided fetch-and-add),
+# so that no rank idles while others run long fission chains. Seeds come from
+# the batch offset (see batch_setup), as in serial batched runs. Each rank
+# keeps the tallies of its batches in a (N_batch_total, N_col) matrix, summed
+# over ranks with MPI_Reduce (exact, as every row is set by one rank) and then
+# in batch order on rank 0: results do not depend on the number of ranks or
+# the batch assignment.
+
+def mpi_simulation(mcdc, data, hostco, N_particle, N_batch):
+    from mpi4py import MPI
+
+    comm = MPI.COMM_WORLD
+    rank = comm.Get_rank()
+
+    offsets = list(range(0, N_particle, N_batch))
+    N_col   = 3 + N_MESH_ESTIMATOR*int(mcdc['N_mesh'])
+    result  = np.zeros((len(offsets), N_col))
+
+    # Batch counter
+    itemsize = MPI.INT64_T.Get_size()
+    window   = MPI.Win.Allocate(itemsize if rank == 0 else 0, itemsize,
+                                comm=comm)
+    if rank == 0:
+        window.Lock(0)
+        window.Put(np.zeros(1, dtype=np.int64), 0)
+        window.Unlock(0)
+    comm.Barrier()
+
+    one  = np.ones(1, dtype=np.int64)
+    idx  = np.zeros(1, dtype=np.int64)
+    while True:
+        window.Lock(0)
+        window.Fetch_and_op(one, idx, 0, op=MPI.SUM)
+        window.Unlock(0)
+        i_batch = int(idx[0])
+        if i_batch >= len(offsets):
+            break
+
+        offset = offsets[i_batch]
+        N      = min(N_batch, N_particle - offset)
+        batch_setup(mcdc, data, hostco, offset, N)
+
+        mcdc['tally']      = 0.0
+        mcdc['mesh_tally'] = 0.0
+        data = simulation(mcdc, data, hostco)
+
+        result[i_batch, :3] = mcdc['tally']
+        result[i_batch, 3:] = mcdc['mesh_tally'].ravel()
+
+    comm.Barrier()
+    window.Free()
+
+    # Reduce, then sum in batch order on rank 0
+    total = np.zeros_like(result) if rank == 0 else None
+    comm.Reduce(result, total, op=MPI.SUM, root=0)
+    if rank != 0:
+        return None
+
+    mcdc['tally']      = 0.0
+    mcdc['mesh_tally'] = 0.0
+    for row in total:
+        mcdc['tally']      += row[:3]
+        mcdc['mesh_tally'] += row[3:].reshape(N_MESH_ESTIMATOR, -1)
+    mcdc['N_source'] += N_particle
+    return data
+
 # =============================================================================
 # Factory
 # =============================================================================
 
-def make_loops(alg, target):
-    global simulation
+def make_loops(alg, target, scheduler='largest', sort=0, fused=()):
+    global simulation, history_loop, schedule, schedule_name, \
+           sort_interval, fused_events, HISTORY_transport
+
+    # Start over from the Python loops, in case an earlier call replaced them
+    globals().update(py_functions)
+
+    # CUDA is only imported for GPU runs
+    global cuda
+    if target == 'gpu' or alg not in ['history', 'event']:
+        from numba import cuda
+
     if alg == 'history':
-        simulation = adapter.loop(HISTORY_simulation, target)
+        sub_target = 'cpu' if target == 'cpus' else target
+        HISTORY_transport = adapter.compiler(HISTORY_transport, sub_target)
+        history_loop      = adapter.loop(HISTORY_simulation, alg, target)
+        simulation        = HISTORY_driver
     elif alg == 'event':
-        simulation = adapter.loop(EVENT_simulation,   target)
+        simulation = adapter.loop(EVENT_simulation,   alg, target)
+        schedule_name = scheduler
+        sort_interval = sort
+        fused_events  = set(e for pair in fused for e in pair)
+        if scheduler == 'largest':
+            schedule = SCHEDULE_largest
+        elif scheduler == 'round-robin':
+            schedule = SCHEDULE_round_robin
+        elif scheduler == 'threshold':
+            schedule = SCHEDULE_threshold
+        elif scheduler == 'drain-tail':
+            schedule = SCHEDULE_drain_tail
+        else:
+            print(f"[ERROR] Unrecognized scheduler '{scheduler}'")
     elif alg == 'async':
         simulation = ASYNC_simulation_factory(True,True)
     elif alg == 'async-multi':
@@ -352,3 +1067,9 @@ def make_loops(alg, target):
         simulation = ASYNC_simulation_factory(False,False)
     else:
         print(f"[ERROR] Unrecognized algorithm type '{alg}'")
+
+# The Python functions of this module, which make_loops replaces with their
+# compiled versions; restored on each call to build another configuration
+py_functions = {name: value for name, value in globals().items()
+                if callable(value)
+                and getattr(value, '__module__', None) == __name__}
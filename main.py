@@ -1,12 +1,12 @@
-print('Location --A{}'.format(1))
-import argparse, sys, time
+import argparse, json, resource, sys, time
+start_up = time.perf_counter()
 import numpy as np
 
-from numba import config
+import numba
 
 
 
-import type_, kernel, loop
+import type_, kernel, loop, adapter
 
 from constant import *
 
@@ -15,176 +15,537 @@ from constant import *
 # =============================================================================
 # INPUT
 # =============================================================================
-
-# Model
-SigmaC     = 0.25
-SigmaS     = 0.5
-SigmaF     = 0.25
-nu         = 2.0
-SigmaT     = SigmaC + SigmaS + SigmaF
-X          = 3.0
-
-# Technique
-branchless_collision = True
-
-# Parameters
-N_particle = int(1E6) #int(1E5)
+# Defaults of the configuration taken by run; the command line below, or a
+# caller of run, overrides any of them
+
+defaults = dict(
+    # Model
+    SigmaC = 0.25,
+    SigmaS = 0.5,
+    SigmaF = 0.25,
+    nu     = 2.0,
+    X      = 3.0,
+
+    # Mode, algorithm, and target
+    mode   = 'numba',   # 'python' or 'numba'
+    alg    = 'history', # 'history', 'event', 'async', 'async-multi',
+                        #  'new-event', or 'new-event-multi'
+    target = 'cpu',     # 'cpu', 'cpus', or 'gpu'
+
+    # Technique
+    branchless_collision = True,
+    soa_bank             = False,     # Structure-of-arrays event bank
+    rng_type             = 'lcg',     # 'lcg' or counter-based 'threefry'
+    cache                = True,      # On-disk cache of the compiled kernels
+    counters             = False,     # Event counters and occupancy statistics
+    scheduler            = 'largest', # Event-based: 'largest', 'round-robin',
+                                      #  'threshold', or 'drain-tail'
+    state_backing        = 'ram',     # Global state memory: 'ram', 'file'
+    state_dir            = None,      #  (memory-mapped file in state_dir, or
+                                      #  the temporary directory), or 'hugepage'
+    sort_interval        = 0,         # Event-based: renumber the bank to follow
+                                      #  the stacks every this many iterations
+    weight_window        = False,     # Roulette below ww_low (survivors get
+    ww_low               = 0.25,      #  ww_survival) and splitting above
+    ww_high              = 4.0,       #  ww_high at collisions
+    ww_survival          = 1.0,
+    fused_events         = [],        # Event-based: pairs of events run in one
+                                      #  pass, (EVENT_MOVE, collision event)
+    comb                 = False,     # Comb the secondaries down to the source
+                                      #  population (event-based) or to
+                                      #  COMB_HISTORY_SIZE (history-based)
+
+    # Parameters
+    N_particle = int(1E6), #int(1E5)
+    N_batch    = None,     # Source particles per batch (None: N_particle);
+                           #  sets the memory footprint
+    N_mesh     = 20,       # Mesh tally bins over [-X, X]
+    rel_error  = 0.0,      # Stop at this tally relative error (0: run
+                           #  N_particle)
+    N_process  = 1,        # History-based worker processes (chunks of N_batch)
+    mpi        = False,    # Distribute batches of N_batch over MPI ranks
+
+    # Checkpoint
+    checkpoint          = None,  # File to snapshot the run to, for a restart
+    checkpoint_interval = 600.0, # Seconds between snapshots
+    restart             = None)  # Checkpoint file to continue the run of
 
 # =============================================================================
 # SETUP
 # =============================================================================
 
-# Mode, algorithm, and target
-parser = argparse.ArgumentParser()
-parser.add_argument('--mode', type=str, choices=['python', 'numba'], 
-                    default='numba')
-parser.add_argument('--alg', type=str, choices=['history', 'event', 'async','async-multi','new-event','new-event-multi'], 
-                    default='history')
-parser.add_argument('--target', type=str, choices=['cpu', 'gpu', 'cpus'],
-                    default='cpu')
-args, unargs = parser.parse_known_args()
-alg = args.alg
-target = args.target
-mode = args.mode
-
-if target == 'gpu':
-    if mode == 'python':
-        print('[ERROR] Python mode cannot run on GPU.')
-        sys.exit()
-    if alg  == 'history':
-        print('[ERROR] GPU run does not support history-based algorithm.')
-        sys.exit()
-    if alg  == 'event' and not branchless_collision: 
-        print('[ERROR] Event-based GPU run currently has to run with branchless collision.')
-        sys.exit()
-else:
-    if alg == 'event':
-        print('[ERROR] Event algorithm currently only supports GPU targets.')
-        sys.exit()
-
-# Pure python mode?
-if mode == 'python':
-    config.DISABLE_JIT = True
-elif mode == 'numba':
-    config.DISABLE_JIT = False
-
-
-# Event stacks
-if branchless_collision:
-    # Remove scattering and fission
-    N_stack = N_EVENT - 2
-else:
-    # Remove branchless_collision
-    N_stack = N_EVENT - 1
-
-#N_stack = N_EVENT
-
-print('Location -A')
-
-# Make types, kernels, and loops
-type_.make_type_global(N_particle, N_stack, alg)
-kernel.make_kernels(alg, target)
-
-loop.make_loops(alg, target)
-
+def check(config, N_particle, N_batch):
+    # Whether the configuration is supported, with the reason if not
+    alg    = config['alg']
+    target = config['target']
+
+    # The collision event following a move
+    if config['branchless_collision']:
+        EVENT_COLLISION = EVENT_BRANCHLESS_COLLISION
+    else:
+        EVENT_COLLISION = EVENT_SCATTERING
+
+    if config['N_process'] > 1 and (alg != 'history' or target != 'cpu'
+                                    or config['rel_error'] > 0.0):
+        print('[ERROR] Multi-process run only supports history-based algorithm on CPU, without convergence check.')
+        return False
+    if config['N_process'] > 1 and threads_started:
+        # Forked workers would inherit the thread pool without its threads
+        print('[ERROR] Multi-process run cannot follow a multithreaded run in the same process.')
+        return False
+
+    if config['mpi']:
+        if alg not in ['history', 'event'] or config['N_process'] > 1 \
+           or config['rel_error'] > 0.0:
+            print('[ERROR] MPI run only supports history- and event-based algorithms, without multi-process or convergence check.')
+            return False
+
+    if (config['weight_window'] or config['comb']) \
+       and (alg not in ['history', 'event'] or target == 'gpu'):
+        print('[ERROR] Population control only supports history- and event-based algorithms on CPU.')
+        return False
+
+    if (config['checkpoint'] or config['restart']) \
+       and (alg not in ['history', 'event'] or config['mpi']
+            or config['N_process'] > 1):
+        print('[ERROR] Checkpoint and restart only support single-process history- and event-based runs.')
+        return False
+
+    fused_events = [tuple(pair) for pair in config['fused_events']]
+    if fused_events and (alg != 'event'
+                         or fused_events != [(EVENT_MOVE, EVENT_COLLISION)]):
+        print('[ERROR] Only move and the collision event can be fused, in event-based runs.')
+        return False
+
+    if config['rel_error'] > 0.0 \
+       and N_particle < CONVERGENCE_MIN_BATCH*N_batch:
+        print(f'[ERROR] Convergence check needs at least {CONVERGENCE_MIN_BATCH} batches (N_particle/N_batch).')
+        return False
+
+    if target == 'gpu':
+        if config['mode'] == 'python':
+            print('[ERROR] Python mode cannot run on GPU.')
+            return False
+        if alg  == 'history':
+            print('[ERROR] GPU run does not support history-based algorithm.')
+            return False
+        if alg  == 'event' and not config['branchless_collision']:
+            print('[ERROR] Event-based GPU run currently has to run with branchless collision.')
+            return False
+    else:
+        if target == 'cpus' and alg not in ['history', 'event']:
+            print('[ERROR] Multithreaded CPU run only supports history- and event-based algorithms.')
+            return False
+    return True
 
-# Allocate global variable container
-mcdc = np.zeros(1, dtype=type_.global_)[0]
-
-# ========================================
-# Set global variables
-# ========================================
-
-# Model
-mcdc['SigmaC'] = SigmaC
-mcdc['SigmaS'] = SigmaS
-mcdc['SigmaF'] = SigmaF
-mcdc['nu']     = nu
-mcdc['SigmaT'] = SigmaT
-mcdc['X']      = X
-
-# Technique
-mcdc['branchless_collision'] = branchless_collision
-
-# RNG
-mcdc['rng_g']     = RNG_G
-mcdc['rng_c']     = RNG_C
-mcdc['rng_mod']   = RNG_MOD
-mcdc['seed']      = RNG_SEED
-
-# Mode-specifics
-if alg == 'history':
-    mcdc['history_based'] = True
-    mcdc['N_history']     = N_particle
-    mcdc['N_particle']    = 1
-else:
-    mcdc['history_based'] = False
-    mcdc['N_history']     = 1
-    mcdc['N_particle']    = N_particle
-
-# Target-specifics
-if target == 'gpu':
-    mcdc['gpu']      = True
-    mcdc['N_thread'] = 32
-else:
-    mcdc['gpu']      = False
-    mcdc['N_thread'] = 1
-
-# ========================================
-# Event-based parameters and helpers
 # ========================================
-if alg == 'event':
-    mcdc['N_stack']   = N_stack
-    mcdc['stack_idx'] = np.arange(N_EVENT)
-    mcdc['event_idx'] = np.arange(N_stack)
-
-    # To initiate stack-driven algorithm
-    mcdc['stack_'][EVENT_SOURCE]['size'] = mcdc['N_particle']
-    mcdc['stack_'][EVENT_NONE]['size']   = \
-                mcdc['stack_'][EVENT_NONE]['content'].shape[0] - mcdc['N_particle']
-
-    # Strides -- number of rands reqired for a given operation
-    mcdc['history_stride']                           = RNG_STRIDE
-    mcdc['event_stride'][EVENT_SOURCE]               = 2
-    mcdc['event_stride'][EVENT_MOVE]                 = 2
-    mcdc['event_stride'][EVENT_SCATTERING]           = 1
-    mcdc['event_stride'][EVENT_FISSION]              = 2
-    mcdc['event_stride'][EVENT_LEAKAGE]              = 0
-    mcdc['event_stride'][EVENT_BRANCHLESS_COLLISION] = 1
-elif alg == 'history':
-    mcdc['history_stride']                           = RNG_STRIDE
-
-# Branchless collision edits
-if alg =='event' and mcdc['branchless_collision']:
-    # Replace (scattering, fission) with (leakage, branchless collision)
-    mcdc['stack_idx'][EVENT_LEAKAGE]              = EVENT_SCATTERING
-    mcdc['stack_idx'][EVENT_BRANCHLESS_COLLISION] = EVENT_FISSION
-    
-    mcdc['event_idx'][EVENT_SCATTERING]           = EVENT_LEAKAGE
-    mcdc['event_idx'][EVENT_FISSION]              = EVENT_BRANCHLESS_COLLISION
-
-    # Reduce move stride
-    mcdc['event_stride'][EVENT_MOVE] = 1
-
+# Compiled engine
 # ========================================
+# The kernels and loops are compiled for the global type, whose array shapes
+# are fixed by the mesh, stack, and buffer counts only: the bank, stacks, and
+# tally partial sums sized by the batch are runtime buffers (see type_). A
+# configuration with the same compile key runs on the engine already built:
+# N_particle, N_batch, cross sections, X, and the population control bounds
+# are runtime values.
+
+engine = None
+threads_started = False # Whether a multithreaded engine was built
+
+def compile_key(config):
+    # The inputs baked into the kernels, loops, or global type
+    return (config['mode'], config['alg'], config['target'],
+            bool(config['branchless_collision']), bool(config['soa_bank']),
+            config['rng_type'], bool(config['cache']),
+            bool(config['counters']), config['scheduler'],
+            config['sort_interval'], bool(config['weight_window']),
+            tuple(tuple(pair) for pair in config['fused_events']),
+            config['N_mesh'])
+
+def build(config):
+    # Make types, kernels, and loops, unless the engine already built can take
+    # the configuration
+    global engine, threads_started
+
+    key = compile_key(config)
+    if engine is not None and engine['key'] == key:
+        return engine
+
+    mode   = config['mode']
+    alg    = config['alg']
+    target = config['target']
+    fused_events = [tuple(pair) for pair in config['fused_events']]
+
+    # Pure python mode?
+    if mode == 'python':
+        numba.config.DISABLE_JIT = True
+    elif mode == 'numba':
+        numba.config.DISABLE_JIT = False
+
+    # Event stacks
+    if config['branchless_collision']:
+        # Remove scattering and fission
+        N_stack = N_EVENT - 2
+    else:
+        # Remove branchless_collision
+        N_stack = N_EVENT - 1
+
+    #N_stack = N_EVENT
+
+    # Thread-private buffers
+    if target == 'cpus':
+        N_buffer = numba.get_num_threads()
+    else:
+        N_buffer = 1
+
+    type_.make_type_global(N_stack=N_stack, alg=alg, N_buffer=N_buffer,
+                           soa_bank=config['soa_bank'],
+                           counters=config['counters'], N_mesh=config['N_mesh'])
+
+    if config['cache'] and mode == 'numba':
+        adapter.set_cache(alg, target, config['branchless_collision'],
+                          config['rng_type'], config['soa_bank'],
+                          mpi=config['mpi'])
+    else:
+        adapter.cache = False
+    kernel.make_kernels(alg, target, config['soa_bank'],
+                        config['rng_type'], config['weight_window'],
+                        fused_events)
+    loop.make_loops(alg, target, config['scheduler'],
+                    config['sort_interval'], fused_events)
+
+    if target == 'cpus' and mode == 'numba':
+        threads_started = True
+
+    engine = dict(key=key, N_stack=N_stack, N_buffer=N_buffer)
+    return engine
+
+def initial_state(config, N_batch):
+    # Global state and host controller of a run on the engine built
+    alg    = config['alg']
+    target = config['target']
+    N_stack  = engine['N_stack']
+    N_buffer = engine['N_buffer']
+
+    # Allocate global variable container, and the runtime buffers with the
+    # initial bank capacity
+    type_.set_state_backing(config['state_backing'], config['state_dir'])
+    mcdc = type_.allocate_global()[0]
+
+    SigmaT    = config['SigmaC'] + config['SigmaS'] + config['SigmaF']
+    bank_size = type_.get_bank_size(N_batch, alg,
+                                    config['nu']*config['SigmaF']/SigmaT,
+                                    config['branchless_collision'])
+    data = type_.allocate_buffers(N_batch, bank_size)
+
+    # ========================================
+    # Set global variables
+    # ========================================
+
+    # Model
+    mcdc['SigmaC'] = config['SigmaC']
+    mcdc['SigmaS'] = config['SigmaS']
+    mcdc['SigmaF'] = config['SigmaF']
+    mcdc['nu']     = config['nu']
+    mcdc['SigmaT'] = config['SigmaC'] + config['SigmaS'] + config['SigmaF']
+    mcdc['X']      = config['X']
+
+    # Technique
+    mcdc['branchless_collision'] = config['branchless_collision']
+    mcdc['weight_window']        = config['weight_window']
+    mcdc['ww_low']               = config['ww_low']
+    mcdc['ww_high']              = config['ww_high']
+    mcdc['ww_survival']          = config['ww_survival']
+    mcdc['comb']                 = config['comb']
+
+    # Thread-private buffers
+    mcdc['N_buffer'] = N_buffer
+
+    # Mesh tally
+    mcdc['N_mesh'] = config['N_mesh']
+
+    # RNG
+    mcdc['rng_g']     = RNG_G
+    mcdc['rng_c']     = RNG_C
+    mcdc['rng_mod']   = RNG_MOD
+    mcdc['seed']      = RNG_SEED
+    kernel.rng_jump_table(mcdc)
+    if config['rng_type'] == 'threefry':
+        # Seed is the counter; the user seed becomes the key
+        mcdc['rng_key'] = RNG_SEED
+        mcdc['seed']    = 0
+    mcdc['seed_start'] = mcdc['seed']
+
+    # Mode-specifics
+    if alg == 'history':
+        mcdc['history_based'] = True
+        mcdc['N_history']     = N_batch
+        mcdc['N_particle']    = 1
+    else:
+        mcdc['history_based'] = False
+        mcdc['N_history']     = 1
+        mcdc['N_particle']    = N_batch
+
+    # Target-specifics
+    if target == 'gpu':
+        mcdc['gpu']      = True
+        mcdc['N_thread'] = 32
+    elif target == 'cpus':
+        mcdc['gpu']      = False
+        mcdc['N_thread'] = N_buffer
+    else:
+        mcdc['gpu']      = False
+        mcdc['N_thread'] = 1
+
+    # ========================================
+    # Event-based parameters and helpers
+    # ========================================
+    if alg == 'event':
+        mcdc['N_stack']   = N_stack
+        mcdc['stack_idx'] = np.arange(N_EVENT)
+        mcdc['event_idx'] = np.arange(N_stack)
+
+        # To initiate stack-driven algorithm
+        mcdc['stack_size'][EVENT_SOURCE] = mcdc['N_particle']
+        mcdc['stack_size'][EVENT_NONE]   = \
+                    data.stack.shape[1] - mcdc['N_particle']
+
+        # Strides -- number of rands reqired for a given operation
+        mcdc['history_stride']                           = RNG_STRIDE
+        mcdc['event_stride'][EVENT_SOURCE]               = 2
+        mcdc['event_stride'][EVENT_MOVE]                 = 2
+        mcdc['event_stride'][EVENT_SCATTERING]           = 1
+        mcdc['event_stride'][EVENT_FISSION]              = 2
+        mcdc['event_stride'][EVENT_LEAKAGE]              = 0
+        mcdc['event_stride'][EVENT_BRANCHLESS_COLLISION] = 1
+    elif alg == 'history':
+        mcdc['history_stride']                           = RNG_STRIDE
+
+    # Branchless collision edits
+    if alg =='event' and mcdc['branchless_collision']:
+        # Replace (scattering, fission) with (leakage, branchless collision)
+        mcdc['stack_idx'][EVENT_LEAKAGE]              = EVENT_SCATTERING
+        mcdc['stack_idx'][EVENT_BRANCHLESS_COLLISION] = EVENT_FISSION
+
+        mcdc['event_idx'][EVENT_SCATTERING]           = EVENT_LEAKAGE
+        mcdc['event_idx'][EVENT_FISSION]              = EVENT_BRANCHLESS_COLLISION
+
+        # Reduce move stride
+        mcdc['event_stride'][EVENT_MOVE] = 1
+
+    # Roulette draw of the weight window
+    if alg == 'event' and config['weight_window']:
+        mcdc['event_stride'][EVENT_SCATTERING]           += 1
+        mcdc['event_stride'][EVENT_BRANCHLESS_COLLISION] += 1
+
+    # Fused events draw the random numbers of both
+    for first, second in config['fused_events']:
+        stride = mcdc['event_stride'][first] + mcdc['event_stride'][second]
+        mcdc['event_stride'][first]  = stride
+        mcdc['event_stride'][second] = stride
+
+    # ========================================
+
+    # Make and set GPU host controller
+    #hostco               = type_.get_hostco(N_stack)
+    hostco = np.zeros(1, dtype=type_.get_hostco(N_stack))[0]
+    if alg not in [ 'async', 'async-multi', 'new-event', 'new-event-multi' ]:
+        hostco['N_thread']   = mcdc['N_thread']
+        hostco['stack_size'] = mcdc['stack_size']
+        hostco['event_idx']  = mcdc['event_idx']
+    return mcdc, data, hostco
 
-# Make and set GPU host controller
-#hostco               = type_.get_hostco(N_stack)
-hostco = np.zeros(1, dtype=type_.get_hostco(N_stack))[0]
-if alg not in [ 'async', 'async-multi', 'new-event', 'new-event-multi' ]:
-    hostco['N_thread']   = mcdc['N_thread']
-    hostco['stack_size'] = mcdc['stack_']['size']
-    hostco['event_idx']  = mcdc['event_idx']
-    print(mcdc['event_idx'])
+# =============================================================================
+# RUN
+# =============================================================================
 
+def run(config={}):
+    # Run a configuration (overrides of defaults) and return its tallies,
+    # or None if it is not supported (or on MPI ranks other than 0). Calls
+    # in the same process reuse the compiled engine where they can.
+    config = dict(defaults, **config)
+    alg    = config['alg']
+
+    N_particle = int(config['N_particle'])
+    N_batch    = N_particle if config['N_batch'] is None \
+                            else min(int(config['N_batch']), N_particle)
+    if config['N_process'] > 1 and N_batch == N_particle:
+        # Enough chunks to balance the load
+        N_batch = max(TALLY_BLOCK, N_particle // (8*config['N_process']))
+    if not check(config, N_particle, N_batch):
+        return None
+
+    # Setup and kernel factories (compilation happens on the first call)
+    start = time.perf_counter()
+    build(config)
+    loop.set_checkpoint(config['checkpoint'], config['checkpoint_interval'])
+    mcdc, data, hostco = initial_state(config, N_batch)
+    build_time = time.perf_counter() - start
+
+    # Continue a checkpointed run
+    if config['restart']:
+        state = loop.restart(config['restart'], N_batch)
+        if state is None:
+            return None
+        mcdc, data = state
+        hostco['stack_size'] = mcdc['stack_size']
+
+    start = time.perf_counter()
+    if config['mpi']:
+        data = loop.mpi_simulation(mcdc, data, hostco, N_particle, N_batch)
+        if data is None:
+            # Results are on rank 0
+            return None
+    elif config['N_process'] > 1:
+        data = loop.pool_simulation(mcdc, data, hostco, N_particle, N_batch,
+                                    config['N_process'])
+    elif alg in ['history', 'event']:
+        data = loop.batch_simulation(mcdc, data, hostco, N_particle, N_batch,
+                                     config['rel_error'])
+    else:
+        data = loop.simulation(mcdc, data, hostco)
+        mcdc['N_source'] = N_particle
+    run_time = time.perf_counter() - start
+
+    if config['counters']:
+        kernel.report_counters(mcdc)
+
+    # Copies, so that the state can be freed
+    return {'tally'           : mcdc['tally'].copy(),
+            'tally_rel_error' : mcdc['tally_rel_error'].copy(),
+            'mesh_tally'      : mcdc['mesh_tally'].copy(),
+            'N_source'        : int(mcdc['N_source']),
+            'build_time'      : build_time,
+            'run_time'        : run_time}
 
 # =============================================================================
-# RUN
+# COMMAND LINE
 # =============================================================================
 
-#print(mcdc)
+if __name__ == '__main__':
+    # Mode, algorithm, and target
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', type=str, choices=['python', 'numba'],
+                        default=defaults['mode'])
+    parser.add_argument('--alg', type=str, choices=['history', 'event', 'async','async-multi','new-event','new-event-multi'],
+                        default=defaults['alg'])
+    parser.add_argument('--target', type=str, choices=['cpu', 'gpu', 'cpus'],
+                        default=defaults['target'])
+
+    # Overrides of the inputs above, and reporting (used by benchmark.py)
+    parser.add_argument('--N_particle', type=float,
+                        default=defaults['N_particle'])
+    parser.add_argument('--N_batch', type=float, default=defaults['N_batch'])
+    parser.add_argument('--rel_error', type=float,
+                        default=defaults['rel_error'])
+    parser.add_argument('--mpi', action='store_true',
+                        help='Distribute batches of N_batch over MPI ranks')
+    parser.add_argument('--N_process', type=int,
+                        default=defaults['N_process'],
+                        help='History-based worker processes (chunks of N_batch)')
+    parser.add_argument('--branchless_collision', type=int, choices=[0, 1],
+                        default=int(defaults['branchless_collision']))
+    parser.add_argument('--state', type=str,
+                        choices=['ram', 'file', 'hugepage'],
+                        default=defaults['state_backing'])
+    parser.add_argument('--state_dir', type=str,
+                        default=defaults['state_dir'])
+    parser.add_argument('--sort_interval', type=int,
+                        default=defaults['sort_interval'])
+    parser.add_argument('--weight_window', type=int, choices=[0, 1],
+                        default=int(defaults['weight_window']))
+    parser.add_argument('--comb', type=int, choices=[0, 1],
+                        default=int(defaults['comb']))
+    parser.add_argument('--fuse', action='store_true',
+                        help='Fuse move with the collision event (event-based)')
+    parser.add_argument('--checkpoint', type=str,
+                        default=defaults['checkpoint'])
+    parser.add_argument('--checkpoint_interval', type=float,
+                        default=defaults['checkpoint_interval'])
+    parser.add_argument('--restart', type=str, default=defaults['restart'],
+                        help='Continue the run of a checkpoint file')
+    parser.add_argument('--no_cache', action='store_true')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Runs on the same kernels; the first one compiles')
+    parser.add_argument('--json', action='store_true',
+                        help='Print a JSON summary as the last line')
+    args, unargs = parser.parse_known_args()
+
+    config = dict(mode                 = args.mode,
+                  alg                  = args.alg,
+                  target               = args.target,
+                  N_particle           = int(args.N_particle),
+                  N_batch              = args.N_batch,
+                  rel_error            = args.rel_error,
+                  mpi                  = args.mpi,
+                  N_process            = args.N_process,
+                  branchless_collision = bool(args.branchless_collision),
+                  cache                = defaults['cache'] and not args.no_cache,
+                  state_backing        = args.state,
+                  state_dir            = args.state_dir,
+                  sort_interval        = args.sort_interval,
+                  weight_window        = bool(args.weight_window),
+                  comb                 = bool(args.comb),
+                  checkpoint           = args.checkpoint,
+                  checkpoint_interval  = args.checkpoint_interval,
+                  restart              = args.restart)
+
+    # The collision event following a move
+    if args.fuse:
+        if config['branchless_collision']:
+            config['fused_events'] = [(EVENT_MOVE, EVENT_BRANCHLESS_COLLISION)]
+        else:
+            config['fused_events'] = [(EVENT_MOVE, EVENT_SCATTERING)]
+
+    if (args.checkpoint or args.restart) and args.repeat > 1:
+        print('[ERROR] Checkpoint and restart only support single runs.')
+        sys.exit()
+
+    # Imports and argument parsing
+    start_up = time.perf_counter() - start_up
+
+    build_time = []
+    run_time   = []
+    for i in range(args.repeat):
+        result = run(config)
+        if result is None:
+            if config['mpi']:
+                # Results are on rank 0
+                continue
+            sys.exit()
+        if i == 0:
+            # Up to the engine built, ready to compile on the first call
+            print(f"[INFO] Startup time ({config['mode']}, {config['alg']}, "
+                  f"{config['target']}): "
+                  f"{start_up + result['build_time']:.3f} s "
+                  f"(build {result['build_time']:.3f} s)")
+        build_time.append(result['build_time'])
+        run_time.append(result['run_time'])
+        print(config['mode'], config['alg'], config['target'],
+              result['tally'], result['run_time'])
+
+    if result is None:
+        sys.exit()
 
-start = time.perf_counter()
-loop.simulation(mcdc, hostco)
-end = time.perf_counter()
-print(mode, alg, target, mcdc['tally'], end-start)
+    # Mesh flux, per source particle and unit length
+    X      = defaults['X']
+    N_mesh = defaults['N_mesh']
+    flux = result['mesh_tally']/(max(result['N_source'], 1)*2.0*X/N_mesh)
+    print('flux (track-length)', np.array2string(flux[MESH_TRACK], precision=3))
+    print('flux (collision)   ', np.array2string(flux[MESH_COLLISION], precision=3))
+
+    if args.json:
+        print(json.dumps({
+            'mode'                 : config['mode'],
+            'alg'                  : config['alg'],
+            'target'               : config['target'],
+            'N_particle'           : config['N_particle'],
+            'N_source'             : result['N_source'],
+            'branchless_collision' : config['branchless_collision'],
+            'build_time'           : build_time,
+            'run_time'             : run_time,
+            'tally'                : result['tally'].tolist(),
+            'tally_rel_error'      : result['tally_rel_error'].tolist(),
+            'mesh_tally'           : result['mesh_tally'].tolist(),
+            # kB on Linux
+            'peak_rss_kb'          : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            }))
@@ -1,3 +1,4 @@
+import collections, math, mmap, tempfile
 import numpy as np
 
 from constant import *
@@ -19,17 +20,6 @@ particle = np.dtype([('x', float64), ('ux', float64), ('w', float64),
 # Particle record (in-bank/stack)
 particle_rec = np.dtype([('x', float64), ('ux', float64), ('w', float64)])
 
-# Particle bank
-def get_type_bank(max_size):
-    return np.dtype([('content', particle_rec, (max_size,)), ('size', int64)])
-
-# =============================================================================
-# Event-based stack of particle indices
-# =============================================================================
-
-def get_type_stack(max_size):
-    return np.dtype([('content', int64, (max_size,)), ('size', int64)])
-
 # =============================================================================
 # Host controller (necessary for GPU run)
 # =============================================================================
@@ -44,18 +34,56 @@ def get_hostco(N_stack):
 # Global data
 # =============================================================================
 
-global_ = None
-def make_type_global(N_particle, N_stack, alg):
-    global global_
+global_      = None
+global_args_ = None
+def make_type_global(N_stack, alg, N_buffer=1, soa_bank=False,
+                     counters=False, N_mesh=1):
+    # The global record holds the model, the fixed-size state, and the stack
+    # sizes. The buffers sized by the batch or the bank are the runtime
+    # buffers below, so the type, and with it the compiled kernels, does not
+    # depend on N_particle or on the bank growing.
+    global global_, global_args_
+
+    # Kept to allocate the runtime buffers
+    global_args_ = dict(N_stack=N_stack, alg=alg, N_buffer=N_buffer,
+                        soa_bank=soa_bank, counters=counters, N_mesh=N_mesh)
 
     struct = [('N_history', int64), ('N_particle', int64), ('N_stack', int64),
 
+              # Index of the first history of the current batch
+              ('history_offset', int64),
+
               ('SigmaC', float64), ('SigmaS', float64), ('SigmaF', float64),
               ('nu', float64), ('SigmaT', float64), ('X', float64),
               ('tally', float64, (3,)), 
+
+              # Source particles run so far, and the relative error of the
+              # tally from its batch-to-batch spread
+              ('N_source', int64), ('tally_rel_error', float64, (3,)),
+
+              # Thread-private tally buffers, flushed into the partial sums
+              # (runtime buffers)
+              ('N_buffer', int64), ('tally_buffer', float64, (N_buffer, 3)),
+
+              # Mesh tally over [-X, X] (track-length and collision flux
+              # estimators), with thread-private buffers as well
+              ('N_mesh', int64),
+              ('mesh_tally', float64, (N_MESH_ESTIMATOR, N_mesh)),
+              ('mesh_buffer', float64, (N_buffer, N_MESH_ESTIMATOR, N_mesh)),
+
+              # Number of partial sums in use
+              ('N_tally_block', int64),
               
               ('rng_g', int64), ('rng_c', int64), ('rng_mod', uint64),
-              ('seed', int64),  ('N_thread', int64)]
+              ('seed', int64),  ('N_thread', int64), ('rng_key', int64),
+
+              # Main seed at the start of the run, which event-based batches
+              # skip ahead from
+              ('seed_start', int64),
+
+              # Skip-ahead coefficients for 2^k steps
+              ('rng_jump_g', int64, (RNG_BITS,)),
+              ('rng_jump_c', int64, (RNG_BITS,))]
 
     
     # ======================================
@@ -69,30 +97,178 @@ def make_type_global(N_particle, N_stack, alg):
                    ('event_stride', int64, (N_EVENT,)),
 
                    ('stack_idx', int64, (N_EVENT,)),
-                   ('event_idx', int64, (N_stack,))]
-
-
-        # Sizes
-        if alg == 'history':
-            bank_size  = 100000
-            stack_size = 0
-        else:
-            bank_size  = int(2*N_particle)
-            stack_size = int(2*N_particle)
+                   ('event_idx', int64, (N_stack,)),
 
-        type_stack = get_type_bank(stack_size)
-        struct += [('bank', get_type_bank(bank_size)), 
-                ('stack_', get_type_stack(stack_size), (N_stack,))]
+                   # Sizes of the event stacks, and of the history banks of
+                   # each thread buffer, with the flag of a full one (int64,
+                   # as Numba has no nested bool arrays)
+                   ('stack_size', int64, (N_stack,)),
+                   ('bank_history_size', int64, (N_buffer,)),
+                   ('bank_history_overflow', int64, (N_buffer,))]
 
-        # ======================================
+    # Thread-private counters, and the event stack sizes of each iteration;
+    # without them, the kernels are built with no-op counting
+    if counters:
+        N_iteration = STACK_HISTORY_SIZE if alg == 'event' else 0
+        struct += [('counter', int64, (N_buffer, N_COUNTER)),
+                   ('stack_history', int64, (N_iteration, N_stack)),
+                   ('stack_history_size', int64)]
 
-        # Secondaries parameters for sync in branching event
-        struct += [('secondaries_stack', int64, (stack_size,)),
-                ('secondaries_counter', int64, (stack_size, N_stack)),
-                ('secondaries_idx', int64, (stack_size, N_stack))]
+    # Population control: weight window bounds, and the weight of roulette
+    # survivors
+    struct += [('ww_low', float64), ('ww_high', float64),
+               ('ww_survival', float64)]
 
     # Bool-typed (TODO: report bug)
     struct += [('history_based', bool_), ('gpu', bool_), 
-            ('branchless_collision', bool_)]
+            ('branchless_collision', bool_), ('bank_overflow', bool_),
+            ('weight_window', bool_), ('comb', bool_)]
 
     global_ = np.dtype(struct)
+
+# =============================================================================
+# Runtime buffers
+# =============================================================================
+# Arrays sized by the batch (N_particle) or the bank, passed to the kernels
+# next to the global record. Numba types them by dtype and dimension only, so
+# they can be allocated for any batch, or grown, without recompiling.
+#
+#   bank                 event-based particle records (AoS), or their x, ux,
+#                        and w rows (SoA)
+#   bank_history         history-based bank of each thread buffer
+#   stack                event stacks of bank indices
+#   secondaries_stack    next stack of each particle of a branching event,
+#   secondaries_counter  and its per-bin histogram and scanned offsets
+#   secondaries_idx
+#   tally_block          tally partial sums, one per block of histories
+#   mesh_block
+#   block_done           history blocks done in the current batch
+
+Buffers = collections.namedtuple('Buffers', ['bank', 'bank_history', 'stack',
+                                             'secondaries_stack',
+                                             'secondaries_counter',
+                                             'secondaries_idx', 'tally_block',
+                                             'mesh_block', 'block_done'])
+
+def get_bank_size(N_particle, alg, multiplication, branchless_collision):
+    # Initial bank capacity from the expected number of fission neutrons per
+    # collision (nu*SigmaF/SigmaT); the bank grows if this turns out short
+    if alg == 'history':
+        return int(math.ceil(BANK_HISTORY_SIZE*(1.0 + multiplication)))
+    elif branchless_collision:
+        # No particle is ever added to the bank
+        return int(N_particle)
+    else:
+        return int(math.ceil(N_particle*(1.0 + multiplication)))
+
+def buffer_layout(N_tally_block, bank_size):
+    # (dtype, shape) of each runtime buffer
+    alg      = global_args_['alg']
+    N_stack  = global_args_['N_stack']
+    N_buffer = global_args_['N_buffer']
+    N_mesh   = global_args_['N_mesh']
+
+    # Sizes
+    if alg == 'history':
+        bank_history_size = bank_size
+        stack_size        = 0
+    else:
+        bank_history_size = 0
+        stack_size        = bank_size
+    N_bin = (stack_size + SECONDARIES_BLOCK - 1) // SECONDARIES_BLOCK
+
+    # Event-based bank layout
+    if global_args_['soa_bank']:
+        bank = (float64, (len(particle_rec.names), stack_size))
+    else:
+        bank = (particle_rec, (stack_size,))
+
+    return Buffers(bank                = bank,
+                   bank_history        = (particle_rec,
+                                          (N_buffer, bank_history_size)),
+                   stack               = (int64, (N_stack, stack_size)),
+                   secondaries_stack   = (int64, (stack_size,)),
+                   secondaries_counter = (int64, (N_bin, N_stack)),
+                   secondaries_idx     = (int64, (N_bin, N_stack)),
+                   tally_block         = (float64, (N_tally_block, 3)),
+                   mesh_block          = (float64, (N_tally_block,
+                                                    N_MESH_ESTIMATOR, N_mesh)),
+                   block_done          = (bool_, (N_tally_block,)))
+
+def allocate_buffers(N_particle, bank_size):
+    # Zeroed runtime buffers for batches of N_particle source particles
+    if global_args_['alg'] == 'history':
+        N_tally_block = (N_particle + TALLY_BLOCK - 1) // TALLY_BLOCK
+    else:
+        N_tally_block = 1
+    return Buffers(*[allocate(dtype, shape) for dtype, shape
+                     in buffer_layout(N_tally_block, bank_size)])
+
+def grow_buffers(data, bank_size):
+    # Runtime buffers with a larger bank (and stacks), with the content copied
+    # over; the buffers of the same size are kept as they are
+    layout = buffer_layout(data.tally_block.shape[0], bank_size)
+    new    = []
+    for old, (dtype, shape) in zip(data, layout):
+        if old.shape == shape:
+            new.append(old)
+        else:
+            new.append(allocate(dtype, shape))
+            copy_state(new[-1], old)
+    return Buffers(*new)
+
+def buffer_size(data):
+    # The bank size the buffers were allocated with
+    if global_args_['alg'] == 'history':
+        return data.bank_history.shape[1]
+    else:
+        return data.stack.shape[1]
+
+# =============================================================================
+# Allocation
+# =============================================================================
+
+# Backing memory of the global state and runtime buffers: 'ram', 'file'
+# (np.memmap of a temporary file in state_dir, so that the OS can page it
+# out), or 'hugepage' (anonymous mapping advised to use transparent huge
+# pages)
+state_backing = 'ram'
+state_dir     = None
+def set_state_backing(backing, path=None):
+    global state_backing, state_dir
+    if backing not in ['ram', 'file', 'hugepage']:
+        print(f"[ERROR] Unrecognized state backing '{backing}'")
+    state_backing = backing
+    state_dir     = path
+
+def allocate(dtype, shape):
+    # Zeroed array in the state backing; the layout, and so the compiled
+    # kernels, are the same for any backing
+    dtype = np.dtype(dtype)
+    size  = dtype.itemsize*int(np.prod(shape))
+    if state_backing == 'file' and size > 0:
+        # Unlinked on creation; the mapping keeps it until the array is freed
+        f = tempfile.TemporaryFile(dir=state_dir, prefix='mcdc_state_')
+        return np.memmap(f, dtype=dtype, mode='w+',
+                         shape=shape).view(np.ndarray)
+    elif state_backing == 'hugepage' and size > 0:
+        buf = mmap.mmap(-1, size, flags=mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS)
+        if hasattr(mmap, 'MADV_HUGEPAGE'):
+            buf.madvise(mmap.MADV_HUGEPAGE)
+        return np.frombuffer(buf, dtype=dtype).reshape(shape)
+    return np.zeros(shape, dtype=dtype)
+
+def allocate_global(dtype=None):
+    # Zeroed one-element array of the global record (or of dtype)
+    if dtype is None:
+        dtype = global_
+    return allocate(dtype, (1,))
+
+def copy_state(dst, src):
+    # Field-wise copy of the overlapping parts of two structured arrays
+    if dst.dtype.names is not None:
+        for name in dst.dtype.names:
+            copy_state(dst[name], src[name])
+    else:
+        idx = tuple(slice(0, min(a, b)) for a, b in zip(dst.shape, src.shape))
+        dst[idx] = src[idx]